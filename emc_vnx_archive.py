@@ -0,0 +1,142 @@
+#!/bin/env python
+
+""" Compressed archive of the raw statistics pulled from each array
+
+    Every sample (the Statistics CSV of each manifest along with the
+    CSVSequence headers) is appended as its own gzip member to a file per
+    array and day, <archive_dir>/<serial>/<YYYYMMDD>.gz.  Next to it an
+    index, <YYYYMMDD>.idx, holds a "StatisticTime offset length" line per
+    sample, so any time range is read back without decompressing the rest
+    of the day. """
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import logging
+from datetime import datetime, timedelta
+
+# User Configurable Parameters
+# --------------------------------
+archive_dir = None      # e.g. "/var/lib/emc_vnx/archive", None disables it
+archive_days = 14       # days of samples kept per array
+compress_level = 6
+
+
+def array_dir(array_serial):
+    return os.path.join(archive_dir, array_serial)
+
+
+def partition(timestamp):
+    """ Returns the name of the partition holding a sample time """
+    return datetime.fromtimestamp(int(timestamp)).strftime("%Y%m%d")
+
+
+def compress(data):
+    """ Returns data as a single gzip member """
+
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_index(index_file):
+    """ Returns the (timestamp, offset, length) entries of an index """
+
+    entries = []
+    try:
+        with open(index_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3:
+                    entries.append(tuple([int(i) for i in fields]))
+    except IOError:
+        pass
+
+    return entries
+
+
+def prune(array_serial):
+    """ Removes the partitions older than archive_days """
+
+    oldest = partition(time.time() - archive_days * 86400)
+    for name in os.listdir(array_dir(array_serial)):
+        if not name.endswith((".gz", ".idx")):
+            continue
+        if name.split(".")[0] < oldest:
+            os.remove(os.path.join(array_dir(array_serial), name))
+
+
+def append_sample(array_serial, timestamp, sequences, statistics):
+    """ Archives one sample, unless a sample with the same StatisticTime
+        was already archived by another collection mode """
+
+    logger = logging.getLogger('discovery')
+
+    if not os.path.isdir(array_dir(array_serial)):
+        os.makedirs(array_dir(array_serial))
+
+    name = os.path.join(array_dir(array_serial), partition(timestamp))
+    new_partition = not os.path.exists(name + ".idx")
+
+    # The index doubles as the lock, modes may pull at the same time
+    with open(name + ".idx", "a") as index:
+        fcntl.flock(index, fcntl.LOCK_EX)
+
+        entries = read_index(name + ".idx")
+        if entries and entries[-1][0] >= int(timestamp):
+            return False
+
+        member = compress(json.dumps({"timestamp": int(timestamp),
+                                      "sequences": sequences,
+                                      "statistics": statistics}))
+
+        with open(name + ".gz", "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(member)
+
+        index.write("%d %d %d\n" % (int(timestamp), offset, len(member)))
+
+    logger.debug("Archived %s sample %s, %d bytes" % (array_serial,
+                                                      timestamp, len(member)))
+
+    if new_partition:
+        prune(array_serial)
+
+    return True
+
+
+def read_samples(array_serial, start, end):
+    """ Yields (timestamp, sequences, statistics) for every archived sample
+        with a StatisticTime from start to end, oldest first """
+
+    day = datetime.fromtimestamp(int(start)).date()
+    last_day = datetime.fromtimestamp(int(end)).date()
+
+    while day <= last_day:
+        name = os.path.join(array_dir(array_serial), day.strftime("%Y%m%d"))
+        day += timedelta(days=1)
+
+        entries = [i for i in read_index(name + ".idx")
+                   if start <= i[0] <= end]
+        if not entries:
+            continue
+
+        with open(name + ".gz", "rb") as f:
+            for timestamp, offset, length in entries:
+                f.seek(offset)
+                sample = json.loads(zlib.decompress(f.read(length),
+                                                    16 + zlib.MAX_WBITS))
+                yield (timestamp, sample["sequences"], sample["statistics"])
+
+
+def parse_time(value):
+    """ Accepts epoch seconds or a local "YYYY-MM-DD HH:MM" time """
+
+    if value.isdigit():
+        return int(value)
+
+    return int(time.mktime(datetime.strptime(value, "%Y-%m-%d %H:%M")
+                           .timetuple()))
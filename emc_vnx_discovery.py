@@ -1,24 +1,28 @@
 #!/bin/env python
 
+import os
+import re
 import sys
 import json
+import time
 import pywbem
 import argparse
 import logging
 import logging.handlers
+import emc_vnx_ecom
+from emc_vnx_ecom import ecom_connect
+from emc_vnx_records import (VolumeRecord, DiskRecord, SPRecord, PortRecord,
+                             PoolRecord, DeviceRecord, SummaryRecord,
+                             BusRecord, EnclosureRecord, records_to_lld)
 
 log_level = logging.INFO
 
+# Discovery keeps a cache of element names, pools and sizes here, the stats
+# collector reuses it to apply the same filters without asking the ECOM
+cache_dir = "/tmp"
+cache_max_age = 3600    # in seconds
 
-def ecom_connect(ecom_ip, ecom_user, ecom_pass, default_namespace="/root/emc"):
-    """ returns a connection to the ecom server """
-    ecom_url = "https://%s:5989" % ecom_ip
-
-    logger = logging.getLogger('discovery')
-    logger.info("Building WBEM Connection to %s" % ecom_url)
-
-    return pywbem.WBEMConnection(ecom_url, (ecom_user, ecom_pass),
-                                 default_namespace="/root/emc")
+element_records = {"volume": VolumeRecord, "disk": DiskRecord}
 
 
 def get_array_instancename(array_serial, ecom_conn):
@@ -38,81 +42,301 @@ def get_array_instancename(array_serial, ecom_conn):
     return None
 
 
-def discover_array_volumes(ecom_conn, array_serial):
-    """Discover the Volumes in the VNX array
+def add_filter_arguments(parser):
+    """ Adds the element filter options shared by discovery and stats """
 
-       Arguments-
-           ecom_conn:     (pyWBEM) pyWBEM connection
+    parser.add_argument('--name_include', action="store", default="",
+                        help="Only keep elements whose name matches regex")
+    parser.add_argument('--name_exclude', action="store", default="",
+                        help="Drop elements whose name matches regex")
+    parser.add_argument('--pool_include', action="store", default="",
+                        help="Only keep elements in pools matching regex")
+    parser.add_argument('--min_size', action="store", type=float, default=0,
+                        help="Drop elements smaller than this many GB")
+    parser.add_argument('--max_size', action="store", type=float, default=0,
+                        help="Drop elements larger than this many GB")
 
-       Returns-
-           Zabbix compatible List of Hashes to be JSONified
-           or appended to additional data
 
-    """
+def filters_from_args(args):
+    """ Returns the filter dict for the parsed arguments, None if the
+        arguments don't filter anything """
+
+    filters = {"name_include": args.name_include,
+               "name_exclude": args.name_exclude,
+               "pool_include": args.pool_include,
+               "min_size": args.min_size,
+               "max_size": args.max_size}
+
+    if not any(filters.values()):
+        return None
+
+    return filters
+
+
+def element_allowed(element, filters):
+    """ Checks one element record against the filters """
+
+    if not filters:
+        return True
+
+    if filters["name_include"] and \
+            not re.search(filters["name_include"], element.name):
+        return False
+    if filters["name_exclude"] and \
+            re.search(filters["name_exclude"], element.name):
+        return False
+    if filters["pool_include"] and \
+            not re.search(filters["pool_include"], element.pool or ""):
+        return False
+
+    size = element.size / float(1024 ** 3)
+    if filters["min_size"] and size < filters["min_size"]:
+        return False
+    if filters["max_size"] and size > filters["max_size"]:
+        return False
+
+    return True
+
+
+def filter_elements(element_info, filters):
+    """ Returns the set of performance ids that pass the filters """
+
+    return set([perf_dev_id for perf_dev_id, element in
+                element_info.iteritems()
+                if element_allowed(element, filters)])
+
+
+def load_element_cache(array_serial, element_type):
+    """ Returns the cached element info, None if missing or too old """
+
+    cache_file = os.path.join(cache_dir, "%s_%s_info.json" % (
+        array_serial, element_type))
+
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except ValueError:
+        return None
+
+    if time.time() - cache["timestamp"] > cache_max_age:
+        return None
+
+    # Caches written before the records were introduced hold dicts
+    if not isinstance(cache["elements"], list):
+        return None
+
+    record_class = element_records[element_type]
+    element_info = dict()
+    for values in cache["elements"]:
+        record = record_class(*values)
+        element_info[record.perf_id] = record
+
+    return element_info
+
+
+def save_element_cache(array_serial, element_type, element_info):
+    """ Writes the element info cache, replacing the file atomically """
+
+    cache_file = os.path.join(cache_dir, "%s_%s_info.json" % (
+        array_serial, element_type))
+    tmp_file = "%s.%d" % (cache_file, os.getpid())
+
+    with open(tmp_file, "w") as f:
+        json.dump({"timestamp": time.time(),
+                   "elements": [i.as_list() for i in
+                                element_info.itervalues()]}, f)
+
+    os.rename(tmp_file, cache_file)
+
+
+def get_pool_members(ecom_conn, array, result_class, id_property,
+                     assoc_class=None):
+    """ Returns a dict of member id_property to (pool name, pool device id)
+        for every pool and RAID group in the array """
+
+    pool_classes = ["EMC_DeviceStoragePool", "EMC_UnifiedStoragePool",
+                    "EMC_VirtualProvisioningPool"]
+
+    members = dict()
+    for c in pool_classes:
+        for pool in ecom_conn.Associators(array, ResultClass=c):
+            if pool["EMCPoolID"][0] == "C":   # RAID Group
+                pool_name = "RAID Group %s" % pool["PoolID"]
+            else:
+                pool_name = pool["PoolID"]
+            pool_id = pool["InstanceID"].replace(" ", "_")
+
+            pool_members = ecom_conn.AssociatorProperties(
+                pool.path, [id_property], AssocClass=assoc_class,
+                ResultClass=result_class)
+
+            for member in pool_members:
+                members[member[id_property]] = (pool_name, pool_id)
+
+    return members
+
+
+def get_volume_info(ecom_conn, array_serial):
+    """ Collects name, pool and size of every volume, keyed by the
+        performance device id, and refreshes the element cache """
 
     array = get_array_instancename(array_serial, ecom_conn)
 
     # Locate all volumes associated with the array
     logger = logging.getLogger('discovery')
     logger.debug("Started volume info collection from ECOM")
-    volumes = ecom_conn.Associators(array, ResultClass="CIM_StorageVolume")
+    volumes = ecom_conn.AssociatorProperties(
+        array, ["EMCBSPInstanceID", "DeviceID", "ElementName",
+                "EMCCurrentOwningStorageProcessor", "BlockSize",
+                "NumberOfBlocks"], ResultClass="CIM_StorageVolume")
+    pools = get_pool_members(ecom_conn, array, "CIM_StorageVolume",
+                             "DeviceID")
     logger.debug("Completed volume info collection ECOM")
 
-    logger.debug("Generating discovery objects")
-    discovered_volumes = []
+    volume_info = dict()
     for volume in volumes:
+        pool_name, pool_id = pools.get(volume["DeviceID"], (None, None))
+
+        # Default owner is reported as SP_A or SP_B
+        owner = volume.get("EMCCurrentOwningStorageProcessor")
+
+        record = VolumeRecord(
+            volume["EMCBSPInstanceID"], volume["DeviceID"],
+            volume["ElementName"], pool_name, pool_id,
+            owner.replace("_", "") if owner else None,
+            volume["BlockSize"] * volume["NumberOfBlocks"])
+        volume_info[record.perf_id] = record
+
+    save_element_cache(array_serial, "volume", volume_info)
 
-        diskitem = dict()
-        diskitem["{#VOLDEVICEID}"] = volume["DeviceID"]
-        diskitem["{#VOLALIAS}"] = volume["ElementName"]
-        diskitem["{#VOLPERFDEVICEID}"] = volume["EMCBSPInstanceID"]
-        diskitem["{#ARRAYSERIAL}"] = array_serial
+    return volume_info
 
-        discovered_volumes.append(diskitem)
-        logger.debug(str(diskitem))
+
+def get_disk_info(ecom_conn, array_serial):
+    """ Collects name, pool and size of every disk, keyed by the
+        performance device id, and refreshes the element cache """
+
+    array = get_array_instancename(array_serial, ecom_conn)
+
+    logger = logging.getLogger('discovery')
+    logger.debug("Started disk info collection from ECOM")
+    physical_disks = ecom_conn.AssociatorProperties(
+        array, ["Name", "MaxMediaSize"], ResultClass="CIM_DiskDrive")
+    pools = get_pool_members(ecom_conn, array, "CIM_DiskDrive", "Name",
+                             "CIM_ConcreteDependency")
+    logger.debug("Completed disk info collection from ECOM")
+
+    disk_info = dict()
+    for disk in physical_disks:
+        perf_dev_id = "CLAR+%s+Disk+%s" % (array_serial, disk["Name"])
+        pool_name, pool_id = pools.get(disk["Name"], (None, None))
+        bus_enc = disk["Name"].split('_')
+
+        disk_info[perf_dev_id] = DiskRecord(
+            perf_dev_id, "CLAR+%s+%s" % (array_serial, disk["Name"]),
+            "Bus %s Enclosure %s Slot %s" % (
+                bus_enc[0], bus_enc[1], bus_enc[2]),
+            pool_name, pool_id,
+            (disk["MaxMediaSize"] or 0) * 1024)   # in KB
+
+    save_element_cache(array_serial, "disk", disk_info)
+
+    return disk_info
+
+
+def discover_array_volumes(ecom_conn, array_serial, filters=None):
+    """Discover the Volumes in the VNX array
+
+       Arguments-
+           ecom_conn:     (pyWBEM) pyWBEM connection
+           filters:       (dict) Optional element filters
+
+       Returns-
+           List of element records, see zabbix_safe_output()
+
+    """
+
+    volume_info = get_volume_info(ecom_conn, array_serial)
+
+    logger = logging.getLogger('discovery')
+    logger.debug("Generating discovery objects")
+    discovered_volumes = []
+    for volume in volume_info.itervalues():
+        if not element_allowed(volume, filters):
+            continue
+
+        discovered_volumes.append(volume)
+        logger.debug(str(volume))
 
     return discovered_volumes
 
 
-def discover_array_disks(ecom_conn, array_serial):
+def discover_array_disks(ecom_conn, array_serial, filters=None):
     """Discover the disks in the VNX array
 
        Arguments-
            ecom_conn:     (pyWBEM) pyWBEM connection
+           filters:       (dict) Optional element filters
 
        Returns-
-           Zabbix compatible List of Hashes to be JSONified or appended
-           to additional data
+           List of element records, see zabbix_safe_output()
 
     """
 
-    array = get_array_instancename(array_serial, ecom_conn)
+    disk_info = get_disk_info(ecom_conn, array_serial)
 
     logger = logging.getLogger('discovery')
-    logger.debug("Started disk info collection from ECOM")
-    physical_disks = ecom_conn.Associators(array, ResultClass="CIM_DiskDrive")
-    logger.debug("Completed disk info collection from ECOM")
-
     logger.debug("Generating discovery objects")
     discovered_disks = []
-    for disk in physical_disks:
+    for disk in disk_info.itervalues():
+        if not element_allowed(disk, filters):
+            continue
 
-        dev_id = "CLAR+%s+%s" % (array_serial, disk["Name"])
-        perf_dev_id = "CLAR+%s+Disk+%s" % (array_serial, disk["Name"])
-        bus_enc = disk["Name"].split('_')
-        dev_name = "Bus %s Enclosure %s Slot %s" % (
-            bus_enc[0], bus_enc[1], bus_enc[2])
+        discovered_disks.append(disk)
+        logger.debug(str(disk))
 
-        diskitem = dict()
-        diskitem["{#DISKDEVICEID}"] = dev_id
-        diskitem["{#DISKPERFDEVICEID}"] = perf_dev_id
-        diskitem["{#ARRAYSERIAL}"] = array_serial
-        diskitem["{#DISKNAME}"] = dev_name
+    return discovered_disks
 
-        discovered_disks.append(diskitem)
-        logger.debug(str(diskitem))
 
-    return discovered_disks
+def discover_disk_locations(ecom_conn, array_serial, level):
+    """Discover the back-end buses or enclosures holding disks, which the
+       stats collection rolls the disk stats up to
+
+       Arguments-
+           ecom_conn:     (pyWBEM) pyWBEM connection
+           level:         (str) "bus" or "enclosure"
+
+       Returns-
+           List of element records, see zabbix_safe_output()
+
+    """
+
+    disk_info = load_element_cache(array_serial, "disk")
+    if disk_info is None:
+        disk_info = get_disk_info(ecom_conn, array_serial)
+
+    logger = logging.getLogger('discovery')
+    logger.debug("Generating discovery objects")
+    locations = dict()
+    for disk in disk_info.itervalues():
+        if level == "bus":
+            record = BusRecord(disk.bus, "Bus %s" % disk.bus)
+            locations[disk.bus] = record
+        else:
+            record = EnclosureRecord(
+                disk.enclosure, "Bus %s Enclosure %s" % tuple(
+                    disk.enclosure.split("_")), disk.bus)
+            locations[disk.enclosure] = record
+
+    discovered_locations = []
+    for location_id in sorted(locations):
+        discovered_locations.append(locations[location_id])
+        logger.debug(str(locations[location_id]))
+
+    return discovered_locations
 
 
 def discover_array_SPs(ecom_conn, array_serial):
@@ -122,8 +346,7 @@ def discover_array_SPs(ecom_conn, array_serial):
            ecom_conn:     (pyWBEM) pyWBEM connection
 
        Returns-
-           Zabbix compatible List of Hashes to be JSONified
-           or appended to additional data
+           List of element records, see zabbix_safe_output()
 
     """
     array = get_array_instancename(array_serial, ecom_conn)
@@ -151,11 +374,7 @@ def discover_array_SPs(ecom_conn, array_serial):
         perf_dev_id = "CLAR+%s+FEAdapt+SP-%s" % (array_serial, sp_name[-1])
         sp_ip = proc['AccessInfo']
 
-        spitem = dict()
-        spitem["{#SPDEVICEID}"] = dev_id
-        spitem["{#SPPERFDEVICEID}"] = perf_dev_id
-        spitem["{#SPNAME}"] = sp_name
-        spitem["{#SPIP}"] = sp_ip
+        spitem = SPRecord(perf_dev_id, dev_id, sp_name, sp_ip)
 
         discovered_procs.append(spitem)
         logger.debug(str(spitem))
@@ -163,6 +382,56 @@ def discover_array_SPs(ecom_conn, array_serial):
     return discovered_procs
 
 
+def discover_array_ports(ecom_conn, array_serial):
+    """Discover the front-end (host facing) ports of the SPs
+
+       Arguments-
+           ecom_conn:     (pyWBEM) pyWBEM connection
+
+       Returns-
+           List of element records, see zabbix_safe_output()
+
+    """
+    array = get_array_instancename(array_serial, ecom_conn)
+
+    logger = logging.getLogger('discovery')
+    logger.debug("Gathering list of SPs from ECOM")
+    sps = ecom_conn.AssociatorNames(array,
+                                    ResultClass="EMC_StorageProcessorSystem")
+    logger.debug("Completed SP list")
+
+    port_classes = [("CIM_FCPort", "FC"), ("CIM_EthernetPort", "iSCSI")]
+
+    discovered_ports = []
+    for sp in sps:
+        sp_name = "SP%s" % sp["Name"].split('_')[-1]
+        for port_class, port_type in port_classes:
+            logger.debug("Collecting %s ports of %s" % (port_type, sp_name))
+            ports = ecom_conn.AssociatorProperties(
+                sp, ["EMCBSPInstanceID", "PortNumber", "ElementName",
+                     "DeviceID"], ResultClass=port_class)
+            for port in ports:
+                # Back-end and management ports carry no front-end stats
+                perf_dev_id = port.get("EMCBSPInstanceID")
+                if not perf_dev_id:
+                    continue
+
+                port_number = port.get("PortNumber")
+                if port_number is None:
+                    port_name = port["ElementName"]
+                else:
+                    port_name = "%s %s Port %s" % (sp_name, port_type,
+                                                   port_number)
+
+                port_item = PortRecord(perf_dev_id, port["DeviceID"],
+                                       port_name, sp_name, port_type)
+
+                discovered_ports.append(port_item)
+                logger.debug(str(port_item))
+
+    return discovered_ports
+
+
 def discover_array_pools(ecom_conn, array_serial):
     """Discover the Pools in the VNX array
 
@@ -170,8 +439,7 @@ def discover_array_pools(ecom_conn, array_serial):
            ecom_conn:     (pyWBEM) pyWBEM connection
 
        Returns-
-           Zabbix compatible List of Hashes to be JSONified
-           or appended to additional data
+           List of element records, see zabbix_safe_output()
 
     """
 
@@ -188,16 +456,14 @@ def discover_array_pools(ecom_conn, array_serial):
         logger.debug("Starting discovery of pools of class: %s" % c)
         for pool in ecom_conn.Associators(array, ResultClass=c):
             pool_name = None
-            pool_item = dict()
             pool_type = pool["EMCPoolID"][0]
             if pool_type == "C":   # RAID Group
                 pool_name = "RAID Group %s" % pool["PoolID"]
             else:
                 pool_name = pool["PoolID"]
 
-            pool_item["{#POOLNAME}"] = pool_name
-            pool_item["{#POOLDEVICEID}"] = pool["InstanceID"].replace(" ", "_")
-            pool_item["{#ARRAYSERIAL}"] = array_serial
+            pool_item = PoolRecord(pool["InstanceID"].replace(" ", "_"),
+                                   pool_name)
 
             discovered_pools.append(pool_item)
             logger.debug(str(pool_item))
@@ -212,8 +478,7 @@ def discover_array_devices(ecom_conn, array_serial):
            ecom_conn:     (pyWBEM) pyWBEM connection
 
        Returns-
-           Zabbix compatible List of Hashes to be JSONified
-           or appended to additional data
+           List of element records, see zabbix_safe_output()
 
     """
 
@@ -229,8 +494,9 @@ def discover_array_devices(ecom_conn, array_serial):
 
     logger.debug("Completed Array Chassis")
 
-    enclosures = ecom_conn.Associators(array_chassis,
-                                       ResultClass="EMC_EnclosureChassis")
+    enclosures = ecom_conn.AssociatorProperties(
+        array_chassis, ["ElementName", "Tag"],
+        ResultClass="EMC_EnclosureChassis")
 
     logger.debug("Completed EnclosureChassis")
 
@@ -241,18 +507,15 @@ def discover_array_devices(ecom_conn, array_serial):
             enc_addr = tuple(i["ElementName"].split('_'))
             enclosure_name = "Bus %s Enclosure %s" % enc_addr
 
-        hardware = {"{#ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["Tag"],
-                    "{#DEVICENAME}": enclosure_name,
-                    "{#DEVICETYPE}": "Enclosure"
-                    }
+        hardware = DeviceRecord(i["Tag"], enclosure_name, "Enclosure")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
 
     # Power Supplies
     logger.debug("Collecting power supplies from ECOM")
-    pow_supplies = ecom_conn.Associators(array, ResultClass="EMC_PowerDevice")
+    pow_supplies = ecom_conn.AssociatorProperties(
+        array, ["DeviceID"], ResultClass="EMC_PowerDevice")
     logger.debug("Completed collecting power supplies from ECOM")
 
     for i in pow_supplies:
@@ -268,18 +531,15 @@ def discover_array_devices(ecom_conn, array_serial):
 
         device = device + supply_side
 
-        hardware = {"{#ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["DeviceID"],
-                    "{#DEVICENAME}": device,
-                    "{#DEVICETYPE}": "Supply"
-                    }
+        hardware = DeviceRecord(i["DeviceID"], device, "Supply")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
 
     # Batteries
     logger.debug("Collecting batteries from ECOM")
-    batteries = ecom_conn.Associators(array, ResultClass="EMC_BatteryDevice")
+    batteries = ecom_conn.AssociatorProperties(
+        array, ["DeviceID"], ResultClass="EMC_BatteryDevice")
     logger.debug("Completed collecting batteries from ECOM")
 
     for i in batteries:
@@ -294,19 +554,15 @@ def discover_array_devices(ecom_conn, array_serial):
 
         device = device + battery_side
 
-        hardware = {"{ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["DeviceID"],
-                    "{#DEVICENAME}": device,
-                    "{#DEVICETYPE}": "Battery"
-                    }
+        hardware = DeviceRecord(i["DeviceID"], device, "Battery")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
 
     # LCC Cards
     logger.debug("Collecting LCC cards from ECOM")
-    lcc_cards = ecom_conn.Associators(array,
-                                      ResultClass="EMC_LinkControlDevice")
+    lcc_cards = ecom_conn.AssociatorProperties(
+        array, ["DeviceID"], ResultClass="EMC_LinkControlDevice")
     logger.debug("Completed collecting LCC cards from ECOM")
 
     for i in lcc_cards:
@@ -318,11 +574,7 @@ def discover_array_devices(ecom_conn, array_serial):
 
         device = device + side
 
-        hardware = {"{ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["DeviceID"],
-                    "{#DEVICENAME}": device,
-                    "{#DEVICETYPE}": "LCC"
-                    }
+        hardware = DeviceRecord(i["DeviceID"], device, "LCC")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
@@ -330,7 +582,8 @@ def discover_array_devices(ecom_conn, array_serial):
     # Fans (Fun fact, NOT all arrays have monitored fans in them!)
     # If no FAN data is reported, physically check your array...
     logger.debug("Collecting Fans from ECOM")
-    fans = ecom_conn.Associators(array, ResultClass="EMC_FanDevice")
+    fans = ecom_conn.AssociatorProperties(
+        array, ["DeviceID"], ResultClass="EMC_FanDevice")
     logger.debug("Completed collecting Fans from ECOM")
 
     for i in fans:
@@ -342,34 +595,27 @@ def discover_array_devices(ecom_conn, array_serial):
 
         device = device + side
 
-        hardware = {"{ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["DeviceID"]+"+Fan",
-                    "{#DEVICENAME}": device,
-                    "{#DEVICETYPE}": "Fan"
-                    }
+        hardware = DeviceRecord(i["DeviceID"]+"+Fan", device, "Fan")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
 
     # Storage Processors
     logger.debug("Collecting SP hardware from ECOM")
-    sps = ecom_conn.Associators(array,
-                                ResultClass="EMC_StorageProcessorSystem")
+    sps = ecom_conn.AssociatorProperties(
+        array, ["Name"], ResultClass="EMC_StorageProcessorSystem")
     logger.debug("Completed collecting SP hardware from ECOM")
     for i in sps:
         device = "Storage Processor %s" % (i["Name"].split('_')[-1])
-        hardware = {"{#ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": i["Name"],
-                    "{#DEVICENAME}": device,
-                    "{#DEVICETYPE}": "SP"
-                    }
+        hardware = DeviceRecord(i["Name"], device, "SP")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
 
     # Disks
     logger.debug("Collecting Disk hardware from ECOM")
-    disks = ecom_conn.Associators(array, ResultClass="CIM_DiskDrive")
+    disks = ecom_conn.AssociatorProperties(
+        array, ["Name"], ResultClass="CIM_DiskDrive")
     logger.debug("Completed collecting Disk hardware from ECOM")
 
     for i in disks:
@@ -378,11 +624,7 @@ def discover_array_devices(ecom_conn, array_serial):
         dev_name = "Disk at Bus %s Enclosure %s Slot %s" % (
             bus_enc[0], bus_enc[1], bus_enc[2])
 
-        hardware = {"{#ARRAYSERIAL}": array_serial,
-                    "{#DEVICEID}": dev_id,
-                    "{#DEVICENAME}": dev_name,
-                    "{#DEVICETYPE}": "Disk"
-                    }
+        hardware = DeviceRecord(dev_id, dev_name, "Disk")
 
         array_hardware.append(hardware)
         logger.debug(str(hardware))
@@ -390,10 +632,42 @@ def discover_array_devices(ecom_conn, array_serial):
     return array_hardware
 
 
-def zabbix_safe_output(data):
-    """ Generate JSON output for zabbix from a passed in list of dicts """
+def discover_summaries(ecom_conn, array_serial):
+    """Lists the distributions sent by the stats --top summary mode
+
+       Arguments-
+           ecom_conn:     (pyWBEM) pyWBEM connection
+
+       Returns-
+           List of element records, see zabbix_safe_output()
+
+    """
+
+    logger = logging.getLogger('discovery')
+
+    # Disks are not owned by an SP and carry no response time counters
+    summaries = [("Volumes", ["Array", "SPA", "SPB"],
+                  ["IOPS", "KBps", "Utilization", "ResponseTime"]),
+                 ("Disks", ["Array"],
+                  ["IOPS", "KBps", "Utilization"])]
+
+    discovered_summaries = []
+    for sum_type, scopes, metrics in summaries:
+        for scope in scopes:
+            for metric in metrics:
+                summary_item = SummaryRecord(sum_type, scope, metric)
+
+                discovered_summaries.append(summary_item)
+                logger.debug(str(summary_item))
+
+    return discovered_summaries
+
+
+def zabbix_safe_output(records, array_serial):
+    """ Generate JSON output for zabbix from a passed in list of records """
     logger = logging.getLogger('discovery')
     logger.info("Generating output")
+    data = records_to_lld(records, array_serial)
     output = json.dumps({"data": data}, indent=4, separators=(',', ': '))
 
     logger.debug(json.dumps({"data": data}))
@@ -436,7 +710,8 @@ def main():
     parser.add_argument('--serial', '-s', action="store",
                         help="Array Serial Number", required=True)
     parser.add_argument('--ecom_ip', '-i', action="store",
-                        help="IP Address of ECOM server", required=True)
+                        help="IP Address of ECOM server, or several ECOM "
+                             "endpoints separated by spaces", required=True)
 
     parser.add_argument('--ecom_user', action="store",
                         help="ECOM Username", default="admin")
@@ -450,35 +725,61 @@ def main():
                        help="Discover Volumes/LUNs")
     group.add_argument('--procs', '-p', action="store_true",
                        help="Discover Storage Processors")
+    group.add_argument('--ports', '-f', action="store_true",
+                       help="Discover Front-end Ports")
     group.add_argument('--pools', '-o', action="store_true",
                        help="Discover Physical Disks")
     group.add_argument('--array', '-a', action="store_true",
                        help="Discover Array devices and enclosures")
+    group.add_argument('--summaries', '-m', action="store_true",
+                       help="Discover Disk/Volume summary distributions")
+    group.add_argument('--buses', action="store_true",
+                       help="Discover back-end buses holding disks")
+    group.add_argument('--enclosures', action="store_true",
+                       help="Discover disk enclosures")
+
+    add_filter_arguments(parser)
+    emc_vnx_ecom.add_ecom_arguments(parser)
 
     args = parser.parse_args()
 
     logger.debug("Arguments parsed: %s" % str(args))
+    emc_vnx_ecom.configure(args)
 
     ecom_conn = ecom_connect(args.ecom_ip, args.ecom_user, args.ecom_pass)
 
     result = None
     if args.disks:
         logger.info("Disk discovery started")
-        result = discover_array_disks(ecom_conn, args.serial)
+        result = discover_array_disks(ecom_conn, args.serial,
+                                      filters_from_args(args))
     elif args.volumes:
         logger.info("Volume discovery started")
-        result = discover_array_volumes(ecom_conn, args.serial)
+        result = discover_array_volumes(ecom_conn, args.serial,
+                                        filters_from_args(args))
     elif args.procs:
         logger.info("Storage Processor discovery started")
         result = discover_array_SPs(ecom_conn, args.serial)
+    elif args.ports:
+        logger.info("Front-end port discovery started")
+        result = discover_array_ports(ecom_conn, args.serial)
     elif args.pools:
         logger.info("Pool discovery started")
         result = discover_array_pools(ecom_conn, args.serial)
     elif args.array:
         logger.info("Array hardware discovery started")
         result = discover_array_devices(ecom_conn, args.serial)
-
-    print zabbix_safe_output(result)
+    elif args.summaries:
+        logger.info("Summary discovery started")
+        result = discover_summaries(ecom_conn, args.serial)
+    elif args.buses:
+        logger.info("Bus discovery started")
+        result = discover_disk_locations(ecom_conn, args.serial, "bus")
+    elif args.enclosures:
+        logger.info("Enclosure discovery started")
+        result = discover_disk_locations(ecom_conn, args.serial, "enclosure")
+
+    print zabbix_safe_output(result, args.serial)
 
     logger.info("Discovery Complete")
 
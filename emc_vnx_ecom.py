@@ -0,0 +1,589 @@
+#!/bin/env python
+
+import os
+import re
+import json
+import errno
+import time
+import socket
+import random
+import inspect
+import pywbem
+import logging
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+import xml.etree.cElementTree as ElementTree
+
+# User Configurable Parameters
+# --------------------------------
+connect_timeout = 5     # in seconds, to open the TCP connection to the ECOM
+read_timeout = 20       # in seconds, for each CIM operation
+retries = 2             # extra attempts for idempotent operations
+backoff = 1.0           # in seconds, doubled (plus jitter) on each retry
+breaker_threshold = 3   # consecutive failed runs before failing fast
+breaker_cooldown = 300  # in seconds, before trying a failed ECOM again
+state_dir = "/tmp"
+ecom_port = 5989        # used when an endpoint doesn't give its own port
+fast_parse = True       # stream large Associators responses, see below
+
+# Operations that only read from the ECOM and are safe to repeat
+idempotent_operations = ["EnumerateInstanceNames", "EnumerateInstances",
+                         "GetInstance", "Associators", "AssociatorNames",
+                         "References", "ReferenceNames"]
+idempotent_methods = ["GetStatisticsCollection"]
+
+# Errors that may mean the ECOM can't be reached, pywbem before 0.8 has no
+# common Error class and reports every HTTP failure as a CIMError
+wbem_errors = (pywbem.CIMError, socket.error)
+if hasattr(pywbem, "Error"):
+    wbem_errors += (pywbem.Error,)
+
+# ECOM health as reported to Zabbix
+HEALTH_OK = 0
+HEALTH_DEGRADED = 1     # Operations needed retries to succeed
+HEALTH_DOWN = 2         # Circuit breaker open, ECOM is not being contacted
+
+
+class ECOMUnavailable(Exception):
+    """ Raised without contacting the ECOM while its breaker is open """
+    pass
+
+
+def add_ecom_arguments(parser):
+    """ Adds the ECOM connection policy options shared by the scripts """
+
+    parser.add_argument('--connect_timeout', action="store", type=float,
+                        help="Seconds to wait for the ECOM to accept",
+                        default=connect_timeout)
+    parser.add_argument('--read_timeout', action="store", type=float,
+                        help="Seconds to wait for each ECOM operation",
+                        default=read_timeout)
+    parser.add_argument('--retries', action="store", type=int,
+                        help="Retries for read-only ECOM operations",
+                        default=retries)
+    parser.add_argument('--no_fast_parse', action="store_true",
+                        help="Build full pywbem instances for every response")
+
+
+def configure(args):
+    """ Applies the parsed connection policy options """
+
+    global connect_timeout, read_timeout, retries, fast_parse
+
+    connect_timeout = args.connect_timeout
+    read_timeout = args.read_timeout
+    retries = args.retries
+    fast_parse = fast_parse and not args.no_fast_parse
+
+
+def breaker_file(ecom_ip):
+    return os.path.join(state_dir, "ecom_%s_breaker.json" % ecom_ip)
+
+
+def load_breaker(ecom_ip):
+    """ Returns the circuit breaker state of the ECOM """
+
+    try:
+        with open(breaker_file(ecom_ip)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {"failures": 0, "opened": None, "degraded": False}
+
+
+def save_breaker(ecom_ip, breaker):
+    tmp_file = "%s.%d" % (breaker_file(ecom_ip), os.getpid())
+
+    with open(tmp_file, "w") as f:
+        json.dump(breaker, f)
+
+    os.rename(tmp_file, breaker_file(ecom_ip))
+
+
+def record_success(ecom_ip, degraded=False):
+    breaker = load_breaker(ecom_ip)
+    if breaker["failures"] or breaker["opened"] or \
+            breaker["degraded"] != degraded:
+        save_breaker(ecom_ip, {"failures": 0, "opened": None,
+                               "degraded": degraded})
+
+
+def record_failure(ecom_ip):
+    logger = logging.getLogger('discovery')
+
+    breaker = load_breaker(ecom_ip)
+    breaker["failures"] += 1
+    if breaker["failures"] >= breaker_threshold:
+        logger.warning("ECOM %s failed %d times, failing fast for %d "
+                       "seconds" % (ecom_ip, breaker["failures"],
+                                    breaker_cooldown))
+        breaker["opened"] = time.time()
+    save_breaker(ecom_ip, breaker)
+
+
+def endpoint_health(name):
+    """ Returns the HEALTH_* state of one endpoint from its breaker state """
+
+    breaker = load_breaker(name)
+    if breaker["opened"]:
+        return HEALTH_DOWN
+    elif breaker["failures"] or breaker["degraded"]:
+        return HEALTH_DEGRADED
+
+    return HEALTH_OK
+
+
+def ecom_health(ecom_ip):
+    """ Returns the HEALTH_* state of the ECOM endpoints of an array, down
+        when none can be used, degraded when any of them has trouble """
+
+    health = [endpoint_health(i["name"]) for i in parse_endpoints(ecom_ip)]
+    if min(health) == HEALTH_DOWN:
+        return HEALTH_DOWN
+
+    return max(health)
+
+
+def check_breaker(ecom_ip):
+    """ Raises ECOMUnavailable while the breaker is open, once the cooldown
+        has passed a single run is let through to probe the ECOM """
+
+    breaker = load_breaker(ecom_ip)
+    if not breaker["opened"]:
+        return
+
+    if time.time() - breaker["opened"] < breaker_cooldown:
+        raise ECOMUnavailable("ECOM %s is failing, not retrying for %d "
+                              "seconds" % (ecom_ip, breaker_cooldown))
+
+    # Half open, let this run through but re-open if it fails again
+    breaker["opened"] = None
+    breaker["failures"] = breaker_threshold - 1
+    save_breaker(ecom_ip, breaker)
+
+
+def parse_endpoints(ecom_ip):
+    """ Returns the endpoints of an --ecom_ip value, a list of
+        [http://|https://]host[:port] separated by spaces or commas """
+
+    endpoints = []
+    for spec in re.split(r"[\s,]+", ecom_ip.strip()):
+        if not spec:
+            continue
+
+        scheme = "https"
+        if "://" in spec:
+            scheme, spec = spec.split("://", 1)
+
+        host, port = spec, ecom_port
+        if ":" in spec:
+            host, port = spec.rsplit(":", 1)
+            port = int(port)
+
+        # The plain https endpoints keep their breaker state under the IP
+        name = host
+        if scheme != "https" or port != ecom_port:
+            name = "%s_%s_%d" % (scheme, host, port)
+
+        endpoints.append({"name": name, "host": host, "port": port,
+                          "url": "%s://%s:%d" % (scheme, host, port)})
+
+    return endpoints
+
+
+def requests_dir(name):
+    return os.path.join(state_dir, "ecom_%s_requests" % name)
+
+
+def outstanding_requests(name):
+    """ Returns how many operations are in flight on the endpoint, from all
+        the scripts running on this host """
+
+    count = 0
+    try:
+        requests = os.listdir(requests_dir(name))
+    except OSError:
+        return 0
+
+    for request in requests:
+        pid = int(request.split(".")[0])
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                # Left behind by a script that was killed
+                try:
+                    os.remove(os.path.join(requests_dir(name), request))
+                except OSError:
+                    pass
+                continue
+        count += 1
+
+    return count
+
+
+def start_request(name, request_id):
+    """ Marks an operation in flight on the endpoint, returns its marker """
+
+    try:
+        os.mkdir(requests_dir(name))
+    except OSError:
+        pass
+
+    marker = os.path.join(requests_dir(name), "%d.%d" % (os.getpid(),
+                                                          request_id))
+    open(marker, "w").close()
+    return marker
+
+
+def end_request(marker):
+    try:
+        os.remove(marker)
+    except OSError:
+        pass
+
+
+def usable_endpoints(endpoints, exclude=()):
+    """ Returns the endpoints that may be contacted, the least busy first
+
+        Endpoints with an open breaker are left out until their cooldown
+        has passed, ties go to healthy endpoints and are then broken at
+        random so concurrent scripts spread over the endpoints """
+
+    usable = []
+    for endpoint in endpoints:
+        if endpoint["name"] in exclude:
+            continue
+        breaker = load_breaker(endpoint["name"])
+        if breaker["opened"] and \
+                time.time() - breaker["opened"] < breaker_cooldown:
+            continue
+        usable.append((outstanding_requests(endpoint["name"]),
+                       endpoint_health(endpoint["name"]), random.random(),
+                       endpoint))
+
+    return [i[-1] for i in sorted(usable)]
+
+
+def retry_delay(attempt):
+    """ Exponential backoff with full jitter """
+    return random.uniform(0, backoff * (2 ** attempt))
+
+
+# CIM-XML types of the values kept by the fast parser, others stay strings
+int_types = ["uint8", "uint16", "uint32", "uint64",
+             "sint8", "sint16", "sint32", "sint64"]
+float_types = ["real32", "real64"]
+
+
+def cim_value(cim_type, text):
+    """ Converts the text of a CIM-XML VALUE element """
+
+    if text is None:
+        return None
+    if cim_type in int_types:
+        return long(text) if len(text) > 9 else int(text)
+    if cim_type in float_types:
+        return float(text)
+    if cim_type == "boolean":
+        return text.strip().lower() == "true"
+    return text
+
+
+def associators_request(conn, object_name, properties, assoc_class=None,
+                        result_class=None):
+    """ Returns the CIM-XML of an Associators call limited to properties,
+        all of them when properties is None """
+
+    namespace = object_name.namespace or conn.default_namespace
+    namespace = "".join(['<NAMESPACE NAME=%s/>' % quoteattr(i)
+                         for i in namespace.split("/") if i])
+
+    # Same as pywbem, the object is sent without host and namespace
+    local_name = object_name.copy()
+    local_name.host = None
+    local_name.namespace = None
+
+    params = ['<IPARAMVALUE NAME="ObjectName">%s</IPARAMVALUE>' %
+              local_name.tocimxml().toxml()]
+    for name, value in (("AssocClass", assoc_class),
+                        ("ResultClass", result_class)):
+        if value:
+            params.append('<IPARAMVALUE NAME="%s"><CLASSNAME NAME=%s/>'
+                          '</IPARAMVALUE>' % (name, quoteattr(value)))
+    if properties is not None:
+        params.append('<IPARAMVALUE NAME="PropertyList"><VALUE.ARRAY>%s'
+                      '</VALUE.ARRAY></IPARAMVALUE>' % "".join(
+                          ["<VALUE>%s</VALUE>" % escape(i)
+                           for i in properties]))
+
+    # wbem_request adds the XML declaration
+    return ('<CIM CIMVERSION="2.0" DTDVERSION="2.0">'
+            '<MESSAGE ID="1001" PROTOCOLVERSION="1.0"><SIMPLEREQ>'
+            '<IMETHODCALL NAME="Associators"><LOCALNAMESPACEPATH>%s'
+            '</LOCALNAMESPACEPATH>%s</IMETHODCALL></SIMPLEREQ></MESSAGE>'
+            '</CIM>' % (namespace, "".join(params)))
+
+
+def parse_instances(response, properties, element="VALUE.OBJECTWITHPATH"):
+    """ Yields a dict of properties for each instance in a CIM-XML response,
+        built as the response is parsed, other properties are never kept
+
+        Raises CIMError if the ECOM returned an error instead """
+
+    wanted = set(properties)
+    record = dict.fromkeys(properties)
+
+    for event, elem in ElementTree.iterparse(StringIO(response)):
+        tag = elem.tag
+        if tag == "PROPERTY":
+            name = elem.get("NAME")
+            if name in wanted:
+                record[name] = cim_value(elem.get("TYPE"),
+                                         elem.findtext("VALUE"))
+            elem.clear()
+        elif tag == "PROPERTY.ARRAY":
+            name = elem.get("NAME")
+            if name in wanted and elem.find("VALUE.ARRAY") is not None:
+                record[name] = [cim_value(elem.get("TYPE"), i.text)
+                                for i in elem.iter("VALUE")]
+            elem.clear()
+        elif tag == element:
+            yield record
+            record = dict.fromkeys(properties)
+            elem.clear()
+        elif tag == "ERROR":
+            raise pywbem.CIMError(int(elem.get("CODE")),
+                                  elem.get("DESCRIPTION"))
+
+
+def instance_properties(instance, properties):
+    """ Returns the properties of a pywbem instance as a dict, None for
+        those it doesn't carry (CIMInstance has no get() before 0.8) """
+
+    return dict([(i, instance[i] if i in instance else None)
+                 for i in properties])
+
+
+def wbem_post(conn, method, data):
+    """ Sends a CIM-XML request the way pywbem does, returns the response
+        body as is """
+
+    from pywbem import cim_http
+
+    headers = ["CIMOperation: MethodCall", "CIMMethod: %s" % method,
+               cim_http.get_object_header(conn.default_namespace)]
+
+    # The TLS and timeout options of wbem_request vary between releases
+    accepted = inspect.getargspec(cim_http.wbem_request)[0]
+    options = dict()
+    for name in ("x509", "verify_callback", "ca_certs", "no_verification",
+                 "timeout"):
+        if name in accepted and getattr(conn, name, None) is not None:
+            options[name] = getattr(conn, name)
+
+    try:
+        return cim_http.wbem_request(conn.url, data, conn.creds, headers,
+                                     **options)
+    except cim_http.AuthError:
+        raise
+    except cim_http.Error, e:
+        # Same as pywbem, HTTP level errors are reported as CIMError
+        raise pywbem.CIMError(0, str(e))
+
+
+def fast_parse_supported(conn):
+    """ The fast path needs the pywbem 0.7/0.8 HTTP layer """
+
+    try:
+        from pywbem import cim_http
+    except ImportError:
+        return False
+    return hasattr(cim_http, "wbem_request") and hasattr(conn, "creds")
+
+
+class ECOMConnection(object):
+    """ Wraps a WBEMConnection to one of the ECOM endpoints of an array,
+        retrying idempotent operations with backoff, failing them over to
+        another endpoint, and keeping the circuit breakers up to date """
+
+    def __init__(self, endpoints, ecom_user, ecom_pass,
+                 default_namespace="/root/emc"):
+        self.endpoints = endpoints
+        self.creds = (ecom_user, ecom_pass)
+        self.default_namespace = default_namespace
+        self.retried = False
+        self.requests = 0
+        self.failed = []
+        self.connect()
+
+    def __getattr__(self, name):
+        if name == "conn":
+            raise AttributeError(name)
+        if name in idempotent_operations:
+            return lambda *args, **kwargs: self.call(conn_method(name),
+                                                     args, kwargs)
+        return getattr(self.conn, name)
+
+    def connect(self):
+        """ Connects to the least busy usable endpoint not failed yet
+
+            Raises ECOMUnavailable when every breaker is open, or the error
+            of the last endpoint tried when none can be reached """
+
+        logger = logging.getLogger('discovery')
+
+        candidates = usable_endpoints(self.endpoints, self.failed)
+        if not candidates and not self.failed:
+            raise ECOMUnavailable(
+                "ECOM %s is failing, not retrying for %d seconds" % (
+                    " ".join([i["name"] for i in self.endpoints]),
+                    breaker_cooldown))
+
+        error = ECOMUnavailable("No ECOM endpoint left to fail over to")
+        for endpoint in candidates:
+            try:
+                check_breaker(endpoint["name"])
+                self.conn = open_endpoint(endpoint, self.creds,
+                                          self.default_namespace)
+            except ECOMUnavailable, e:
+                # Another script opened the breaker in the meantime
+                error = e
+            except socket.error, e:
+                logger.warning("ECOM %s unreachable (%s)" % (
+                    endpoint["name"], str(e)))
+                record_failure(endpoint["name"])
+                error = e
+            else:
+                self.endpoint = endpoint
+                self.ecom_ip = endpoint["name"]
+                logger.info("Using ECOM endpoint %s" % endpoint["url"])
+                return
+            self.failed.append(endpoint["name"])
+
+        raise error
+
+    def AssociatorProperties(self, ObjectName, PropertyList, AssocClass=None,
+                             ResultClass=None):
+        """ Associators returning only PropertyList of each instance, as
+            plain dicts (missing properties are None) rather than pywbem
+            instances
+
+            On the big arrays most of the time of an enumeration goes to
+            building the full instances, the fast path parses the response
+            as it goes instead.  Without it, or when the response can't be
+            parsed, the instances come from the standard Associators and
+            are turned into the same dicts. """
+
+        logger = logging.getLogger('discovery')
+
+        if fast_parse and fast_parse_supported(self.conn):
+            request = associators_request(self.conn, ObjectName,
+                                          PropertyList, AssocClass,
+                                          ResultClass)
+            post = lambda conn: wbem_post(conn, "Associators", request)
+            post.__name__ = "Associators"
+            response = self.call(post, (), {})
+            try:
+                return list(parse_instances(response, PropertyList))
+            except SyntaxError, e:
+                logger.warning("Fast parse of %s failed (%s), using the "
+                               "standard parser" % (ResultClass, str(e)))
+
+        kwargs = {"ResultClass": ResultClass, "PropertyList": PropertyList}
+        if AssocClass:
+            kwargs["AssocClass"] = AssocClass
+        return [instance_properties(i, PropertyList)
+                for i in self.Associators(ObjectName, **kwargs)]
+
+    def InvokeMethod(self, method, *args, **kwargs):
+        operation = conn_method("InvokeMethod")
+        if method in idempotent_methods:
+            return self.call(operation, (method,) + args, kwargs)
+        return self.call(operation, (method,) + args, kwargs, 0)
+
+    def call(self, operation, args, kwargs, attempts=None):
+        """ Runs operation(conn, *args, **kwargs), once retries run out on
+            an endpoint retryable operations move on to the next one """
+
+        logger = logging.getLogger('discovery')
+
+        if attempts is None:
+            attempts = retries
+
+        attempt = 0
+        while True:
+            self.requests += 1
+            marker = start_request(self.ecom_ip, self.requests)
+            try:
+                result = operation(self.conn, *args, **kwargs)
+                record_success(self.ecom_ip, self.retried)
+                return result
+            except wbem_errors, e:
+                # pywbem reports HTTP failures as CIMError 0, any other
+                # code means the ECOM answered and the request was bad
+                if isinstance(e, pywbem.CIMError) and e.args[0]:
+                    raise
+                if attempt >= attempts:
+                    record_failure(self.ecom_ip)
+                    if not attempts:
+                        raise
+                    failed = self.ecom_ip
+                    self.failed.append(failed)
+                    try:
+                        self.connect()
+                    except (ECOMUnavailable, socket.error):
+                        raise e
+                    logger.warning("ECOM %s %s failed (%s), failed over to "
+                                   "%s" % (failed, operation.__name__, str(e),
+                                           self.ecom_ip))
+                    self.retried = False
+                    attempt = 0
+                    continue
+                delay = retry_delay(attempt)
+                logger.warning("ECOM %s %s failed (%s), retrying in %.1fs" % (
+                    self.ecom_ip, operation.__name__, str(e), delay))
+                self.retried = True
+                attempt += 1
+                time.sleep(delay)
+            finally:
+                end_request(marker)
+
+
+def conn_method(name):
+    """ Returns a function calling the method name of a WBEMConnection """
+
+    operation = lambda conn, *args, **kwargs: getattr(conn, name)(*args,
+                                                                  **kwargs)
+    operation.__name__ = name
+    return operation
+
+
+def open_endpoint(endpoint, creds, default_namespace):
+    """ Returns a WBEMConnection to the endpoint once it accepts a TCP
+        connection, raises socket.error otherwise """
+
+    # Fail fast on a dead or hung ECOM before handing off to pywbem
+    probe = socket.create_connection((endpoint["host"], endpoint["port"]),
+                                     connect_timeout)
+    probe.close()
+
+    try:
+        return pywbem.WBEMConnection(endpoint["url"], creds,
+                                     default_namespace=default_namespace,
+                                     timeout=read_timeout)
+    except TypeError:
+        # pywbem before 0.8 has no timeout, fall back to the socket default
+        socket.setdefaulttimeout(read_timeout)
+        return pywbem.WBEMConnection(endpoint["url"], creds,
+                                     default_namespace=default_namespace)
+
+
+def ecom_connect(ecom_ip, ecom_user, ecom_pass, default_namespace="/root/emc"):
+    """ returns a connection to the ecom server, ecom_ip may list several
+        endpoints serving the array, see parse_endpoints() """
+
+    logger = logging.getLogger('discovery')
+    logger.info("Building WBEM Connection to %s" % ecom_ip)
+
+    return ECOMConnection(parse_endpoints(ecom_ip), ecom_user, ecom_pass,
+                          default_namespace)
@@ -0,0 +1,281 @@
+#!/bin/env python
+
+""" Serves the values last sent by emc_vnx_stats.py as OpenMetrics
+
+    The collector keeps a copy of what it sends in export_dir (see
+    export_dir in emc_vnx_stats.py), this only reads those files, so a
+    scrape never reaches the ECOM.  The payload is rendered when the files
+    change, into the idle one of two buffers which is then swapped in, and
+    every scrape is answered from the live buffer as is. """
+
+import os
+import re
+import sys
+import gzip
+import time
+import argparse
+import threading
+import logging
+import logging.handlers
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+log_level = logging.INFO
+
+# User Configurable Parameters
+# --------------------------------
+export_dir = "/tmp/emc_vnx_export"  # must match export_dir in emc_vnx_stats
+listen_address = "127.0.0.1"
+listen_port = 9658
+refresh_interval = 15   # in seconds, how often export_dir is checked
+max_age = 900           # in seconds, older files are left out as stale
+
+content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Zabbix key parameters become these labels, keys with other parameter
+# counts are labelled param1, param2, ...
+key_labels = {1: ["element"],
+              3: ["type", "scope", "stat"]}
+
+
+def metric_name(zabbix_key):
+    """ Returns the OpenMetrics name of a zabbix key """
+
+    name = zabbix_key.split("[", 1)[0]
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def key_params(zabbix_key):
+    """ Returns the parameters between the brackets of a zabbix key """
+
+    if "[" not in zabbix_key:
+        return []
+    return zabbix_key[zabbix_key.index("[") + 1:-1].split(",")
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+        "\n", "\\n")
+
+
+def parse_values(lines):
+    """ Yields (name, labels, timestamp, value) for the numeric values of
+        zabbix_sender lines, text values have no place in OpenMetrics """
+
+    for line in lines:
+        fields = line.rstrip("\n").split(" ", 3)
+        if len(fields) != 4:
+            continue
+        host, zabbix_key, timestamp, value = fields
+
+        try:
+            float(value)
+        except ValueError:
+            continue
+
+        params = key_params(zabbix_key)
+        names = key_labels.get(len(params), [
+            "param%d" % (i + 1) for i in range(len(params))])
+
+        labels = [("array", host)] + zip(names, params)
+        yield (metric_name(zabbix_key), labels, timestamp, value)
+
+
+def render(files):
+    """ Renders the values of the export files as an OpenMetrics payload,
+        samples of the same metric are grouped as the format requires """
+
+    families = dict()
+    for export_file in files:
+        with open(export_file) as f:
+            for name, labels, timestamp, value in parse_values(f):
+                families.setdefault(name, []).append(
+                    "%s{%s} %s %s\n" % (
+                        name, ",".join(["%s=\"%s\"" % (k, escape_label(v))
+                                        for k, v in labels]),
+                        value, timestamp))
+
+    out = StringIO()
+    for name in sorted(families.keys()):
+        out.write("# TYPE %s unknown\n" % name)
+        out.writelines(families[name])
+
+    out.write("# TYPE emc_vnx_exporter_render_timestamp_seconds gauge\n")
+    out.write("emc_vnx_exporter_render_timestamp_seconds %d\n" % time.time())
+    out.write("# EOF\n")
+
+    return out.getvalue()
+
+
+def export_files():
+    """ Returns the export files fresh enough to serve, with their mtimes """
+
+    files = dict()
+    now = time.time()
+
+    try:
+        names = os.listdir(export_dir)
+    except OSError:
+        return files
+
+    for name in names:
+        if not name.endswith("_data.tmp"):
+            continue
+        path = os.path.join(export_dir, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if now - mtime <= max_age:
+            files[path] = mtime
+
+    return files
+
+
+class Payloads(object):
+    """ Two pre-rendered payloads, scrapes read the live one while the
+        other is rendered, then the two are swapped """
+
+    def __init__(self):
+        self.buffers = [("", ""), ("", "")]
+        self.live = 0
+        self.files = None
+
+    def current(self):
+        """ Returns the live (plain, gzip) payload """
+        return self.buffers[self.live]
+
+    def refresh(self):
+        """ Renders into the idle buffer if the export files changed """
+
+        files = export_files()
+        if files == self.files:
+            return False
+
+        payload = render(sorted(files.keys()))
+
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+            f.write(payload)
+
+        idle = 1 - self.live
+        self.buffers[idle] = (payload, compressed.getvalue())
+        self.live = idle
+        self.files = files
+
+        return True
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        plain, compressed = self.server.payloads.current()
+
+        body = plain
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = compressed
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger = logging.getLogger('discovery')
+        logger.debug("%s %s" % (self.client_address[0], format % args))
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def refresh_loop(payloads):
+    """ Keeps the payloads up to date with the export files """
+
+    logger = logging.getLogger('discovery')
+    while True:
+        try:
+            if payloads.refresh():
+                logger.debug("Rendered %d export files" % len(payloads.files))
+        except Exception, e:
+            logger.exception("Rendering failed: %s" % str(e))
+        time.sleep(refresh_interval)
+
+
+def log_exception_handler(type, value, tb):
+    logger = logging.getLogger('discovery')
+    logger.exception("Uncaught exception: {0}".format(str(value)))
+
+
+def setup_logging(log_file):
+    """ Sets up our file logging with rotation """
+    my_logger = logging.getLogger('discovery')
+    my_logger.setLevel(log_level)
+
+    handler = logging.handlers.RotatingFileHandler(
+                          log_file, maxBytes=5120000, backupCount=5)
+
+    formatter = logging.Formatter(
+        '%(asctime)s %(levelname)s %(process)d %(message)s')
+    handler.setFormatter(formatter)
+
+    my_logger.addHandler(handler)
+
+    sys.excepthook = log_exception_handler
+
+    return
+
+
+def main():
+
+    global export_dir
+
+    log_file = '/tmp/emc_vnx_exporter.log'
+    setup_logging(log_file)
+
+    logger = logging.getLogger('discovery')
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--export_dir', '-e', action="store",
+                        help="Directory the collector exports values to",
+                        default=export_dir)
+    parser.add_argument('--address', '-a', action="store",
+                        help="Address to listen on", default=listen_address)
+    parser.add_argument('--port', '-p', action="store", type=int,
+                        help="Port to listen on", default=listen_port)
+    parser.add_argument('--once', action="store_true",
+                        help="Print the payload once and exit, for testing")
+
+    args = parser.parse_args()
+    logger.debug("Arguments parsed: %s" % str(args))
+
+    export_dir = args.export_dir
+
+    payloads = Payloads()
+    payloads.refresh()
+
+    if args.once:
+        sys.stdout.write(payloads.current()[0])
+        sys.exit()
+
+    refresher = threading.Thread(target=refresh_loop, args=(payloads,))
+    refresher.daemon = True
+    refresher.start()
+
+    server = MetricsServer((args.address, args.port), MetricsHandler)
+    server.payloads = payloads
+
+    logger.info("Serving metrics on %s:%d" % (args.address, args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/bin/env python
+
+""" Compact records for the elements of an array
+
+    Discovery, the health check and the stats collection all keep their
+    elements as these slotted records, with ids interned so the same
+    string is shared between the records and the stats rows.  They are
+    only turned into Zabbix discovery dicts or sender lines on output. """
+
+
+def intern_id(value):
+    """ Interns an element id, ECOM ids are plain ASCII """
+    if value is None:
+        return None
+    return intern(str(value))
+
+
+class Record(object):
+    """ Base for the element records
+
+        fields lists the slots in order, used for the cache and for the
+        positional constructor.  lld_macros maps Zabbix discovery macros to
+        fields, lld_serial adds {#ARRAYSERIAL} to the discovery output """
+
+    __slots__ = ()
+    fields = ()
+    id_fields = ()
+    lld_macros = ()
+    lld_serial = True
+
+    def __init__(self, *args, **kwargs):
+        for field, value in zip(self.fields, args):
+            setattr(self, field, value)
+        for field in self.fields[len(args):]:
+            setattr(self, field, kwargs.get(field))
+        for field in self.id_fields:
+            setattr(self, field, intern_id(getattr(self, field)))
+
+    def as_list(self):
+        return [getattr(self, field) for field in self.fields]
+
+    def lld(self, array_serial):
+        """ Returns the Zabbix low level discovery dict for the record """
+
+        item = dict()
+        for macro, field in self.lld_macros:
+            item[macro] = getattr(self, field)
+        if self.lld_serial:
+            item["{#ARRAYSERIAL}"] = array_serial
+        return item
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            ["%s=%r" % (field, getattr(self, field)) for field in self.fields]))
+
+
+class VolumeRecord(Record):
+    __slots__ = ("perf_id", "device_id", "name", "pool", "pool_id", "owner",
+                 "size")
+    fields = __slots__
+    id_fields = ("perf_id", "device_id", "pool_id", "owner")
+    lld_macros = (("{#VOLDEVICEID}", "device_id"),
+                  ("{#VOLALIAS}", "name"),
+                  ("{#VOLPERFDEVICEID}", "perf_id"))
+
+
+class DiskRecord(Record):
+    """ The bus and enclosure of a disk come from its id, which ends in
+        bus_enclosure_slot """
+
+    __slots__ = ("perf_id", "device_id", "name", "pool", "pool_id", "size")
+    fields = __slots__
+    id_fields = ("perf_id", "device_id", "pool_id")
+    lld_macros = (("{#DISKDEVICEID}", "device_id"),
+                  ("{#DISKPERFDEVICEID}", "perf_id"),
+                  ("{#DISKNAME}", "name"))
+
+    @property
+    def bus(self):
+        return self.perf_id.rsplit("+", 1)[-1].split("_")[0]
+
+    @property
+    def enclosure(self):
+        return "_".join(self.perf_id.rsplit("+", 1)[-1].split("_")[:2])
+
+
+class BusRecord(Record):
+    __slots__ = ("bus_id", "name")
+    fields = __slots__
+    id_fields = ("bus_id",)
+    lld_macros = (("{#BUSID}", "bus_id"),
+                  ("{#BUSNAME}", "name"))
+
+
+class EnclosureRecord(Record):
+    __slots__ = ("enclosure_id", "name", "bus_id")
+    fields = __slots__
+    id_fields = ("enclosure_id", "bus_id")
+    lld_macros = (("{#ENCID}", "enclosure_id"),
+                  ("{#ENCNAME}", "name"),
+                  ("{#ENCBUSID}", "bus_id"))
+
+
+class SPRecord(Record):
+    __slots__ = ("perf_id", "device_id", "name", "ip")
+    fields = __slots__
+    id_fields = ("perf_id", "device_id")
+    lld_macros = (("{#SPDEVICEID}", "device_id"),
+                  ("{#SPPERFDEVICEID}", "perf_id"),
+                  ("{#SPNAME}", "name"),
+                  ("{#SPIP}", "ip"))
+    lld_serial = False
+
+
+class PortRecord(Record):
+    __slots__ = ("perf_id", "device_id", "name", "sp", "port_type")
+    fields = __slots__
+    id_fields = ("perf_id", "device_id", "sp")
+    lld_macros = (("{#PORTDEVICEID}", "device_id"),
+                  ("{#PORTPERFDEVICEID}", "perf_id"),
+                  ("{#PORTNAME}", "name"),
+                  ("{#PORTSP}", "sp"),
+                  ("{#PORTTYPE}", "port_type"))
+
+
+class PoolRecord(Record):
+    __slots__ = ("device_id", "name")
+    fields = __slots__
+    id_fields = ("device_id",)
+    lld_macros = (("{#POOLNAME}", "name"),
+                  ("{#POOLDEVICEID}", "device_id"))
+
+
+class DeviceRecord(Record):
+    """ Hardware devices, status (a severity code) and the detail text are
+        only filled in by the health check """
+
+    __slots__ = ("device_id", "name", "device_type", "status", "detail")
+    fields = __slots__
+    id_fields = ("device_id",)
+    lld_macros = (("{#DEVICEID}", "device_id"),
+                  ("{#DEVICENAME}", "name"),
+                  ("{#DEVICETYPE}", "device_type"))
+
+
+class SummaryRecord(Record):
+    __slots__ = ("summary_type", "scope", "metric")
+    fields = __slots__
+    lld_macros = (("{#SUMTYPE}", "summary_type"),
+                  ("{#SUMSCOPE}", "scope"),
+                  ("{#SUMMETRIC}", "metric"))
+
+
+def records_to_lld(records, array_serial):
+    """ Converts records into the list of dicts used for discovery JSON """
+    return [record.lld(array_serial) for record in records]
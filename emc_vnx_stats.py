@@ -3,14 +3,25 @@
 import os
 import csv
 import sys
+import json
+import time
+import fcntl
 import argparse
 import pywbem
-import StringIO
+import itertools
 import subprocess
 import logging
 import logging.handlers
+from functools import partial
 from collections import defaultdict
 from datetime import datetime, timedelta
+import emc_vnx_ecom
+import emc_vnx_archive
+from emc_vnx_ecom import ecom_connect, ECOMUnavailable
+from emc_vnx_discovery import (add_filter_arguments, filters_from_args,
+                               filter_elements, load_element_cache,
+                               get_volume_info, get_disk_info)
+from emc_vnx_records import DeviceRecord, intern_id
 
 log_level = logging.INFO
 
@@ -19,6 +30,62 @@ log_level = logging.INFO
 sender_command = "/usr/local/bin/zabbix_sender"
 config_path = "/etc/zabbix_agentd.conf"
 sample_interval = 5    # in minutes, must be >= 5
+state_dir = "/tmp"     # where per-array state between runs is kept
+
+# Statistics reported for each metric in --summary mode
+summary_percentiles = [50, 95, 99]
+
+# Runs are budgeted to finish this many seconds before the --timeout given
+# (the zabbix_server.conf Timeout), the statistics pulled from the array are
+# shared between runs for pull_cache_age seconds.  A run waits for another
+# run's pull until its deadline, or up to pull_lock_wait seconds without one.
+deadline_margin = 3
+pull_cache_age = 60
+pull_lock_wait = 300
+
+# Arrays only produce a sample every sample_interval, the collector learns
+# when each array rolls over and only pulls past that point.  Runs without
+# a deadline (background runs) wait up to align_wait seconds for a sample
+# that is about to be ready.
+align_wait = 60
+
+# Volumes with more than this percentage of their IOs going through the
+# SP that doesn't own them are counted in NonOwnerVolumes
+non_owner_threshold = 20
+
+# Every volume and disk keeps an exponentially weighted mean and variance
+# of its key metrics, following about baseline_span samples, and is scored
+# by how many deviations its latest sample is from them once it has seen
+# baseline_warmup samples.  Deviations smaller than the floor of a metric
+# are not scored, elements scoring over anomaly_threshold are counted as
+# anomalous.
+baseline_span = 288
+baseline_warmup = 12
+anomaly_threshold = 4
+anomaly_floor = {"IOPS": 5, "KBps": 100, "Utilization": 2,
+                 "ResponseTime": 1}
+
+# Pool capacity forecasts come from a regression of the consumed and
+# subscribed capacity of each pool over time, where samples lose half their
+# weight every forecast_half_life days.  Forecasts are sent once the samples
+# span forecast_min_span days, time to full is capped at forecast_horizon
+# days, which is also sent for pools that aren't filling up.
+forecast_half_life = 14
+forecast_min_span = 1
+forecast_horizon = 3650
+
+# The hardware status text is only sent when it changes, and again for
+# every device once every health_detail_refresh seconds
+health_detail_refresh = 86400
+
+# Values are shipped in batches of at most sender_batch_size values, each by
+# its own zabbix_sender, with up to sender_concurrency of them running at once
+sender_batch_size = 20000
+sender_concurrency = 4
+
+# When set, the last values sent for each array and mode are also kept here
+# for emc_vnx_exporter.py to serve, e.g. "/tmp/emc_vnx_export"
+export_dir = None
 
 # Globals
 # --------------------------------
@@ -26,12 +93,29 @@ stat_manifest_info = dict()
 stat_manifest_info["SP"] = {"InstanceID": "FEAdapt", "ManifestID": 2}
 stat_manifest_info["Volumes"] = {"InstanceID": "Volume", "ManifestID": 5}
 stat_manifest_info["Disks"] = {"InstanceID": "Disk", "ManifestID": 1}
+stat_manifest_info["Ports"] = {"InstanceID": "FEPort", "ManifestID": 3}
+stat_manifest_info["Snapshots"] = {"InstanceID": "Snap", "ManifestID": 4}
+
+# Deadline of the current run, None when it may run to completion
+deadline = None
+
+# Set by --quiet to skip echoing every value sent to stdout
+quiet = False
+
+# Shared SenderBatches while several arrays are collected in one run
+sender = None
+
+# Set by --no_send to only print the values, e.g. when replaying the archive
+no_send = False
+
+# The archived sample being replayed in place of a pull from the ECOM
+replay_pull = None
 
 # These align with the proper entries in Clar_Blockmanifest
 # 0 = Array
 # 1 = Disks
 # 2 = SPs
-# 3 = SP Ports
+# 3 = SP Ports (front-end)
 # 4 = Snap
 # 5 = Volumes
 
@@ -61,6 +145,167 @@ def total_seconds(timedelta):
         (timedelta.seconds + timedelta.days * 24 * 3600) * 10 ** 6) / 10 ** 6
 
 
+def load_state(name):
+    """ Returns the saved state dict for name, empty if there is none """
+
+    state_file = os.path.join(state_dir, "%s_state.json" % name)
+
+    if not os.path.isfile(state_file):
+        return dict()
+
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except ValueError:
+        logger = logging.getLogger('discovery')
+        logger.warning("Discarding unreadable state file %s" % state_file)
+        return dict()
+
+
+def save_state(name, state):
+    """ Saves the state dict for name, replacing the file atomically """
+
+    state_file = os.path.join(state_dir, "%s_state.json" % name)
+    tmp_file = "%s.%d" % (state_file, os.getpid())
+
+    # json.dump() goes through the pure Python encoder, dumps() doesn't
+    with open(tmp_file, "w") as f:
+        f.write(json.dumps(state))
+
+    os.rename(tmp_file, state_file)
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a stage of the run won't finish before the deadline """
+    pass
+
+
+class PullLockTimeout(Exception):
+    """ Raised when another run holds the statistics pull for too long """
+    pass
+
+
+def set_deadline(timeout):
+    global deadline
+    deadline = time.time() + timeout - deadline_margin
+
+
+def stage_fits(array_serial, stage):
+    """ Checks the time left against how long stage took in earlier runs """
+
+    if deadline is None:
+        return True
+
+    estimate = load_state("%s_runtime" % array_serial).get(stage)
+    if estimate is None:
+        return True
+
+    return deadline - time.time() > estimate
+
+
+def record_runtime(array_serial, stage, seconds):
+    """ Keeps a moving average of how long each stage of a run takes """
+
+    state_name = "%s_runtime" % array_serial
+    runtime = load_state(state_name)
+    runtime[stage] = round(0.5 * runtime.get(stage, seconds) + 0.5 * seconds,
+                           3)
+    save_state(state_name, runtime)
+
+
+def acquire_run_lock(array_serial, mode, wait=False, timeout=None):
+    """ Returns the held lock file for this array and mode, None if another
+        run holds it and wait is not set, or it is still held after timeout
+        seconds of waiting """
+
+    lock_file = open(os.path.join(state_dir, "%s_%s.lock" % (
+        array_serial, mode)), "w")
+
+    flags = fcntl.LOCK_EX
+    if not wait or timeout is not None:
+        flags |= fcntl.LOCK_NB
+
+    give_up = time.time() + (timeout or 0)
+    while True:
+        try:
+            fcntl.flock(lock_file, flags)
+            return lock_file
+        except IOError:
+            if not wait or time.time() >= give_up:
+                lock_file.close()
+                return None
+        time.sleep(min(0.5, max(give_up - time.time(), 0)))
+
+
+def spawn_background():
+    """ Restarts this collection in the background without a deadline """
+
+    logger = logging.getLogger('discovery')
+    logger.info("Handing collection off to a background run")
+
+    argv = [i for i in sys.argv[1:] if i not in ["--background", "-b"]]
+
+    devnull = open(os.devnull, "r+")
+    subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0])] +
+                     argv + ["--no_deadline"],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+
+
+def print_last_run(array_serial, manifest_info):
+    """ Prints the status of the last completed run in place of this one """
+
+    status = load_state("%s_%s_status" % (array_serial, manifest_info))
+    if not status:
+        print "No completed collection yet"
+        return
+
+    print "Last completed run: %s    Stat Time: %s    Values: %d%s" % (
+        datetime.fromtimestamp(status["finished"]).strftime("%c"),
+        datetime.fromtimestamp(int(status["timestamp"])).strftime("%c"),
+        status["values"], "    (partial)" if status["partial"] else "")
+
+
+def load_pull_cache(array_serial):
+    """ Returns the statistics pulled by a recent run, None if too old """
+
+    pull = load_state("%s_pull" % array_serial)
+    if not pull or time.time() - pull["fetched"] > pull_cache_age:
+        return None
+
+    return pull
+
+
+def pull_timestamp(pull):
+    """ Returns the local StatisticTime of a pull, None if it has no rows """
+
+    for manifest in stat_manifest_info.itervalues():
+        for instance_id, header_row in pull["sequences"].iteritems():
+            if manifest["InstanceID"] not in instance_id:
+                continue
+            timestamp_index = header_row.index("StatisticTime")
+            for row in StatRows(pull["statistics"][manifest["ManifestID"]]):
+                return convert_to_local(row[timestamp_index]).strftime("%s")
+
+    return None
+
+
+def archive_pull(array_serial, pull):
+    """ Appends a pull to the raw sample archive, a failure to archive is
+        logged and doesn't stop the collection """
+
+    logger = logging.getLogger('discovery')
+
+    try:
+        timestamp = pull_timestamp(pull)
+        if timestamp is not None:
+            emc_vnx_archive.append_sample(array_serial, timestamp,
+                                          pull["sequences"],
+                                          pull["statistics"])
+    except (IOError, OSError), e:
+        logger.warning("Unable to archive statistics: %s" % str(e))
+
+
 def get_array_instancename(ecom_conn, array_serial):
     """ Returns the InstanceName of the array serial provided """
 
@@ -73,14 +318,6 @@ def get_array_instancename(ecom_conn, array_serial):
     return None
 
 
-def ecom_connect(ecom_ip, ecom_user, ecom_pass, default_namespace="/root/emc"):
-    """ returns a connection to the ecom server """
-    ecom_url = "https://%s:5989" % ecom_ip
-
-    return pywbem.WBEMConnection(ecom_url, (ecom_user, ecom_pass),
-                                 default_namespace="/root/emc")
-
-
 def get_sample_interval(ecom_conn, array_serial):
     """ Returns the current sample interval in minutes """
 
@@ -113,11 +350,77 @@ def set_sample_interval(ecom_conn, array_serial, sample_interval):
     return
 
 
-def get_stats(array_serial, ecom_ip, instance_id, ecom_user="admin",
-              ecom_pass="#1Password"):
-    """ Collect performance statistics """
+def sample_due(array_serial):
+    """ Returns when the next sample of the array is expected to be ready,
+        None until its phase has been learnt or when the learnt phase is
+        more than two intervals ahead, as the array's clock went back """
 
-    ecom_conn = ecom_connect(ecom_ip, ecom_user, ecom_pass)
+    phase = load_state("%s_phase" % array_serial)
+    if "stat_time" not in phase:
+        return None
+
+    due = phase["stat_time"] + phase["interval"] + phase["lag"]
+    if due - time.time() > 2 * phase["interval"]:
+        return None
+
+    return due
+
+
+def learn_phase(array_serial, timestamp):
+    """ Updates the sample interval and the lag between StatisticTime and
+        the sample showing up on the ECOM with a newly pulled sample """
+
+    state_name = "%s_phase" % array_serial
+    phase = load_state(state_name)
+    stat_time = int(timestamp)
+
+    last = phase.get("stat_time")
+    if last is not None and stat_time == last:
+        return
+
+    if last is not None and stat_time < last:
+        # The StatisticTime went back, a clock change or a reset of the
+        # statistics on the array, its phase is learnt again
+        logger = logging.getLogger('discovery')
+        logger.info("%s StatisticTime went back %ds, learning its phase "
+                    "again" % (array_serial, last - stat_time))
+        phase = dict()
+        last = None
+
+    interval = phase.get("interval", sample_interval * 60)
+    if last is not None and 0 < stat_time - last <= 2 * sample_interval * 60:
+        interval = stat_time - last
+
+    # Each pull is at or after the sample appeared, the lowest lag seen is
+    # the closest, it may creep back up by a second a sample on clock drift
+    lag = max(time.time() - stat_time, 0)
+    if "lag" in phase:
+        lag = min(lag, phase["lag"] + 1)
+
+    save_state(state_name, {"stat_time": stat_time, "interval": interval,
+                            "lag": round(lag, 1)})
+
+
+def probe_statistic_time(ecom_conn, array):
+    """ Returns the StatisticTime of the latest sample from the array's own
+        statistics instance, a single small query, None if not available """
+
+    try:
+        data = ecom_conn.Associators(
+            array, AssocClass="CIM_ElementStatisticalData",
+            ResultClass="CIM_BlockStorageStatisticalData",
+            PropertyList=["StatisticTime"])
+    except pywbem.CIMError:
+        return None
+
+    if not data or data[0]["StatisticTime"] is None:
+        return None
+
+    return int(convert_to_local(str(data[0]["StatisticTime"])).strftime("%s"))
+
+
+def pull_stats(array_serial, ecom_conn, array):
+    """ Pulls the statistics of every manifest from the array """
 
     # Check and set the sample interval
     interval = get_sample_interval(ecom_conn, array_serial)
@@ -125,16 +428,15 @@ def get_stats(array_serial, ecom_ip, instance_id, ecom_user="admin",
         set_sample_interval(ecom_conn, array_serial, sample_interval)
 
     # Determine the sequence our Stats are coming in from the Manifest
-    array = get_array_instancename(ecom_conn, array_serial)
     man_coll = ecom_conn.AssociatorNames(
         array, ResultClass="CIM_BlockStatisticsManifestCollection")[0]
 
     manifests = ecom_conn.Associators(
         man_coll, ResultClass="CIM_BlockStatisticsManifest")
 
+    sequences = dict()
     for i in manifests:
-        if instance_id in i["InstanceID"]:
-            header_row = i["CSVSequence"]
+        sequences[i["InstanceID"]] = i["CSVSequence"]
 
     # Grab our stats
     stats_service = ecom_conn.AssociatorNames(
@@ -144,20 +446,347 @@ def get_stats(array_serial, ecom_ip, instance_id, ecom_user="admin",
                                          stats_service,
                                          StatisticsFormat=pywbem.Uint16(2))
 
-    return (header_row, stat_output[1]["Statistics"])
+    return {"fetched": time.time(), "sequences": sequences,
+            "statistics": list(stat_output[1]["Statistics"])}
+
+
+def fetch_stats(array_serial, ecom_ip, ecom_user, ecom_pass):
+    """ Returns a new pull once the array has rolled over to a new sample,
+        otherwise the last pull, which every mode has already sent or is
+        still the latest sample for it """
+
+    logger = logging.getLogger('discovery')
+
+    last = load_state("%s_pull" % array_serial)
+    due = sample_due(array_serial)
+    if last and due is not None and time.time() < due:
+        logger.debug("Next %s sample due in %ds, no pull" % (
+            array_serial, due - time.time()))
+        return last
+
+    if not stage_fits(array_serial, "pull"):
+        raise DeadlineExceeded("Not enough time left to pull statistics")
+
+    started = time.time()
+    ecom_conn = ecom_connect(ecom_ip, ecom_user, ecom_pass)
+    array = get_array_instancename(ecom_conn, array_serial)
+
+    # Past the expected rollover, check the sample is there before pulling,
+    # an older sample than the last one means the array was reset
+    if last and due is not None:
+        probed = probe_statistic_time(ecom_conn, array)
+        last_time = load_state("%s_phase" % array_serial)["stat_time"]
+        if probed is not None and probed == last_time:
+            logger.debug("%s sample not ready yet, no pull" % array_serial)
+            return last
+
+    pull = pull_stats(array_serial, ecom_conn, array)
+
+    # Shared with the other collection modes for this array
+    save_state("%s_pull" % array_serial, pull)
+    record_runtime(array_serial, "pull", time.time() - started)
+
+    timestamp = pull_timestamp(pull)
+    if timestamp is not None:
+        learn_phase(array_serial, timestamp)
+
+    if emc_vnx_archive.archive_dir:
+        archive_pull(array_serial, pull)
+
+    return pull
+
+
+def wait_for_sample(array_serial):
+    """ Runs without a deadline sleep until the next sample is due, when it
+        is due within align_wait, so it is sent as soon as it's ready """
+
+    due = sample_due(array_serial)
+    if due is None:
+        return
+
+    wait = due - time.time()
+    if 0 < wait <= align_wait:
+        logger = logging.getLogger('discovery')
+        logger.debug("Waiting %ds for the next %s sample" % (wait,
+                                                           array_serial))
+        time.sleep(wait)
+
+
+def get_stats(array_serial, ecom_ip, instance_id, ecom_user="admin",
+              ecom_pass="#1Password"):
+    """ Collect performance statistics """
+
+    pull = replay_pull
+    if pull is None:
+        pull = load_pull_cache(array_serial)
+
+    if pull is None:
+        if deadline is None:
+            wait_for_sample(array_serial)
+
+        # One pull per array at a time, the others use the one it made,
+        # waiting no longer than the deadline allows
+        wait = pull_lock_wait
+        if deadline is not None:
+            wait = max(deadline - time.time(), 0)
+        pull_lock = acquire_run_lock(array_serial, "pull", wait=True,
+                                     timeout=wait)
+        if pull_lock is None:
+            raise PullLockTimeout("Another run has been pulling %s "
+                                  "statistics for too long, skipping" %
+                                  array_serial)
+        try:
+            pull = load_pull_cache(array_serial)
+            if pull is None:
+                pull = fetch_stats(array_serial, ecom_ip, ecom_user,
+                                   ecom_pass)
+        finally:
+            pull_lock.close()
+
+    header_row = None
+    for i in pull["sequences"].keys():
+        if instance_id in i:
+            header_row = pull["sequences"][i]
+
+    return (header_row, pull["statistics"])
+
+
+def iter_lines(data):
+    """ Yields the lines of data without splitting it all up front """
+
+    start = 0
+    while start < len(data):
+        end = data.find("\n", start)
+        if end == -1:
+            end = len(data)
+        yield data[start:end]
+        start = end + 1
+
+
+class StatRows(object):
+    """ Rows of a Statistics CSV payload, parsed as they are iterated """
+
+    def __init__(self, stat_data):
+        self.stat_data = stat_data
+
+    def __iter__(self):
+        reader = csv.reader(iter_lines(self.stat_data), delimiter=';')
+        for row in reader:
+            if not row:
+                continue
+            yield row
+
+
+class SenderBatches(object):
+    """ Writes sender lines out to batch files of at most batch_size values
+        and ships each full batch with its own zabbix_sender, keeping up to
+        concurrency of them running at once
+
+        Every line names its own host, so one set of batches can carry the
+        values of any number of arrays.  The batch files are named after
+        stat_file and the process, so concurrent runs never share one """
+
+    def __init__(self, stat_file, host=None, batch_size=None,
+                 concurrency=None):
+        self.stat_file = stat_file
+        self.host = host
+        self.batch_size = batch_size or sender_batch_size
+        self.concurrency = concurrency or sender_concurrency
+
+        self.batch = None
+        self.batch_file = None
+        self.batch_values = 0
+        self.batches = 0
+        self.running = []
+        self.count = 0
+
+    def add(self, line):
+        if self.batch is None:
+            # Runs of other modes may be sending under the same stat_file
+            self.batch_file = "%s.%d.%d" % (self.stat_file, os.getpid(),
+                                            self.batches)
+            self.batch = open(self.batch_file, "w")
+
+        self.batch.write(line)
+        self.batch.write("\n")
+        self.batch_values += 1
+        self.count += 1
+
+        if self.batch_values >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Starts a zabbix_sender for the batch being written """
+
+        if self.batch is None:
+            return
+
+        self.batch.close()
+
+        while len(self.running) >= self.concurrency:
+            self.reap()
+
+        command = [sender_command, "-v", "-c", config_path, "-T",
+                   "-i", self.batch_file]
+        if self.host:
+            command[-2:-2] = ["-s", self.host]
+
+        self.running.append((subprocess.Popen(command), self.batch_file))
+
+        self.batch = None
+        self.batch_values = 0
+        self.batches += 1
+
+    def reap(self):
+        """ Waits for the oldest zabbix_sender, its batch file is kept for
+            troubleshooting only if it failed outright """
+
+        process, batch_file = self.running.pop(0)
+        result = process.wait()
+
+        # zabbix_sender returns 2 when only some of the values were taken
+        if result == 1:
+            logger = logging.getLogger('discovery')
+            logger.warning("zabbix_sender failed to send %s" % batch_file)
+        else:
+            os.remove(batch_file)
+
+    def close(self):
+        """ Sends what is left and waits for every batch, returns the
+            number of values sent """
+
+        self.flush()
+        while self.running:
+            self.reap()
+
+        return self.count
+
+
+def send_values(array_serial, lines, stat_file):
+    """ Streams the sender lines into batches next to stat_file, echoing
+        them unless quiet, and returns the value count
+
+        While a shared sender is open the lines join its batches, and are
+        sent along with those of the other arrays when it is closed
+
+        With an export_dir the lines are also kept there, replacing the
+        last set sent under the same stat_file name, unless they are only
+        printed or replayed from the archive, which would pass old values
+        off as current """
+
+    batches = sender
+    if no_send:
+        batches = None
+    elif batches is None:
+        batches = SenderBatches(stat_file, array_serial)
+
+    export = None
+    if export_dir and not no_send and replay_pull is None:
+        export_file = os.path.join(export_dir, os.path.basename(stat_file))
+        export = open("%s.%d" % (export_file, os.getpid()), "w")
+
+    count = 0
+    for line in lines:
+        if batches:
+            batches.add(line)
+        if export:
+            export.write(line)
+            export.write("\n")
+        if not quiet:
+            print line
+        count += 1
+
+    if export:
+        export.close()
+        os.rename(export.name, export_file)
+
+    if batches and batches is not sender:
+        batches.close()
+
+    if not quiet:
+        print "\n"
+
+    return count
+
+
+def format_values(array_serial, timestamp, values):
+    """ Turns (zabbix_key, value) tuples into zabbix_sender lines """
+
+    for zabbix_key, value in values:
+        yield "%s %s %s %s" % (array_serial, zabbix_key, timestamp, value)
+
+
+def quote_value(text):
+    """ Returns text as a quoted zabbix_sender value, with its quotes and
+        backslashes escaped and line breaks turned into spaces """
+
+    text = text.replace("\\", "\\\\").replace("\"", "\\\"")
+    return "\"%s\"" % " ".join(text.splitlines())
+
+
+def row_values(header_row, rows, skip_fields, send_ids=None):
+    """ Yields (zabbix_key, value) for every counter of every row """
+
+    perf_dev_id_index = header_row.index("InstanceID")
+    fields = [i for i in range(0, len(header_row)) if i not in skip_fields]
+
+    for row in rows:
+
+        perf_dev_id = row[perf_dev_id_index]
+        if send_ids is not None and perf_dev_id not in send_ids:
+            continue
+
+        for i in fields:
+            if row[i] == "18446744073709551615":   # If the data is N/A
+                continue
+            zabbix_key = "emc.vnx.perf.%s[%s]" % (header_row[i], perf_dev_id)
+            yield (zabbix_key, row[i])
+
+
+def derived_values(header_row, sample, array_serial, timestamp, processors,
+                   skip_ids, stage, started):
+    """ Yields the values of each processor, timing the whole stage from
+        started """
+
+    for processor in processors:
+        for zabbix_key, value in processor(header_row, sample,
+                                           array_serial, timestamp):
+            if key_element(zabbix_key) in skip_ids:
+                continue
+            yield (zabbix_key, value)
+    record_runtime(array_serial, stage, time.time() - started)
 
 
 def process_stats(header_row, stat_output, array_serial, manifest_info,
-                  ignore_fields=[]):
-    """ Pushes statistics out to Zabbix """
+                  ignore_fields=[], processors=[], top_n=None,
+                  allowed_ids=None, element_info=None):
+    """ Pushes statistics out to Zabbix
+
+        processors is a list of functions called with the header row, the
+        CounterSample, the array serial and the timestamp of a new dataset,
+        each returning an iterable of (zabbix_key, value) tuples to be sent
+        along with it.  The rows are parsed once, the counters the summary
+        and the processors work from are all read in a single pass over
+        them and saved to one state file.
+
+        When top_n is set only the array and per-SP summaries are sent,
+        along with the stats of the top_n busiest elements.  The per-SP
+        summaries group the elements by their owner in element_info
+
+        When allowed_ids is set, the values of any other element are
+        dropped.  The sample still covers every row, so totals by pool, SP
+        or location cover all elements """
+
+    if header_row is None:
+        print "No %s statistics manifest reported by the array" % manifest_info
+        return
 
     sp_data = stat_output[stat_manifest_info[manifest_info]["ManifestID"]]
-    f = StringIO.StringIO(sp_data)
-    reader = csv.reader(f, delimiter=';')
 
     timestamp_index = header_row.index("StatisticTime")
     perf_dev_id_index = header_row.index("InstanceID")
 
+
     ignore_fields = ignore_fields + ["ElementType",
                                      "StatisticTime",
                                      "InstanceID"]
@@ -167,25 +796,15 @@ def process_stats(header_row, stat_output, array_serial, manifest_info,
     for i in ignore_fields:
         skip_fields.append(header_row.index(i))
 
-    zabbix_data = []
-
     timestamp = None
-    for row in reader:
-
-        if not timestamp:
-            timestamp = convert_to_local(row[timestamp_index]).strftime("%s")
+    for row in StatRows(sp_data):
+        timestamp = convert_to_local(row[timestamp_index]).strftime("%s")
+        break
 
-        perf_dev_id = row[perf_dev_id_index]
+    if timestamp is None:
+        print "No %s statistics reported by the array" % manifest_info
+        return
 
-        for i in range(0, len(header_row)):
-            if i in skip_fields:
-                continue
-            elif row[i] == "18446744073709551615":   # If the data is N/A
-                continue
-            zabbix_key = "emc.vnx.perf.%s[%s]" % (header_row[i], perf_dev_id)
-            zabbix_data.append("%s %s %s %s" % (array_serial, zabbix_key,
-                                                timestamp, row[i]))
-            
     print "------------------------------------------------------"
     current_time = datetime.now().strftime("%c")
     stat_time = datetime.fromtimestamp(int(timestamp)).strftime("%c")
@@ -194,30 +813,412 @@ def process_stats(header_row, stat_output, array_serial, manifest_info,
     # Check if we've already collected and sent this dataset
     last_stat = None
 
-    last_file = "/tmp/%s_last.tmp" % manifest_info
-    stat_file = "/tmp/%s_data.tmp" % manifest_info
+    last_file = os.path.join(state_dir, "%s_%s_last.tmp" % (array_serial,
+                                                            manifest_info))
+    stat_file = os.path.join(state_dir, "%s_%s_data.tmp" % (array_serial,
+                                                            manifest_info))
 
     if os.path.isfile(last_file):
         with open(last_file) as f:
             last_stat = f.readline()
 
-    if timestamp != last_stat:
-        with open(stat_file, "w") as f:
-            f.write("\n".join(zabbix_data))
+    if timestamp == last_stat:
+        print "Already posted stats to Zabbix, skipping"
+        print "------------------------------------------------------\n"
+        return
+
+    all_rows = list(StatRows(sp_data))
+    rows = all_rows
+    if allowed_ids is not None:
+        rows = [row for row in all_rows
+                if row[perf_dev_id_index] in allowed_ids]
+
+    # Derived values are left out when the deadline is too close, the raw
+    # counters still go out and the run is flagged as partial
+    stage = "%s_derived" % manifest_info
+    partial_run = False
+    if processors and not stage_fits(array_serial, stage):
+        logger = logging.getLogger('discovery')
+        logger.warning("Skipping derived %s stats, deadline too close" %
+                       manifest_info)
+        processors = []
+        partial_run = True
+
+    started = time.time()
+    sample = None
+    if top_n is not None or processors:
+        sample = CounterSample(header_row, all_rows,
+                               "%s_%s_counters" % (array_serial,
+                                                   manifest_info),
+                               timestamp, summary_counters + group_counters +
+                               balance_counters + location_counters)
+
+    summary = []
+    send_ids = None
+    skip_ids = set()
+    if top_n is not None:
+        summary, send_ids, element_ids = summary_stats(
+            header_row, sample, array_serial, manifest_info, timestamp,
+            top_n, element_info, allowed_ids)
+        skip_ids = element_ids - send_ids
+
+    derived = []
+    if processors:
+        if allowed_ids is not None:
+            skip_ids = skip_ids | (sample.dev_ids - allowed_ids)
+        derived = derived_values(header_row, sample, array_serial,
+                                 timestamp, processors, skip_ids, stage,
+                                 started)
+
+    partial = [("emc.vnx.collector.Partial[%s]" % manifest_info,
+                int(partial_run))]
+
+    # Nothing below builds the full set of values, each one is formatted
+    # and written out to the sender file as it is generated
+    values = itertools.chain(summary,
+                             row_values(header_row, rows, skip_fields,
+                                        send_ids),
+                             derived, partial)
+
+    count = send_values(array_serial,
+                        format_values(array_serial, timestamp, values),
+                        stat_file)
+
+    with open(last_file, "w") as f:
+        f.write(timestamp)
+
+    save_state("%s_%s_status" % (array_serial, manifest_info),
+               {"finished": time.time(), "timestamp": timestamp,
+                "values": count, "partial": partial_run})
 
-        subprocess.call([sender_command, "-v", "-c", config_path,
-                         "-s", array_serial, "-T", "-i", stat_file])
+    print "------------------------------------------------------\n"
 
-        print "\n".join(zabbix_data)
-        print "\n"
 
-        with open(last_file, "w") as f:
-            f.write(timestamp)
+def key_element(zabbix_key):
+    """ Returns the element id between the brackets of a zabbix key """
+    return zabbix_key[zabbix_key.find("[") + 1:-1]
 
-    else:
-        print "Already posted stats to Zabbix, skipping"
 
-    print "------------------------------------------------------\n"
+class CounterSample(object):
+    """ The counters of every element of a dataset, read in a single pass
+        over its rows, and their deltas against the last sample kept in
+        state_name
+
+        current holds a dict of element values per counter present in
+        header_row, deltas a dict of counter deltas per element and
+        interval the seconds since the last sample.  Elements seen for the
+        first time, or whose counters went backwards, have no deltas until
+        the next sample """
+
+    def __init__(self, header_row, rows, state_name, timestamp, counters):
+        counters = [(i, header_row.index(i)) for i in set(counters)
+                    if i in header_row]
+        perf_dev_id_index = header_row.index("InstanceID")
+
+        self.current = dict([(i[0], dict()) for i in counters])
+        for row in rows:
+            # One id string per element, shared by all the counter dicts
+            dev_id = intern_id(row[perf_dev_id_index])
+            for counter, index in counters:
+                if row[index] and row[index] != "18446744073709551615":
+                    self.current[counter][dev_id] = int(row[index])
+
+        self.dev_ids = set()
+        for values in self.current.itervalues():
+            self.dev_ids.update(values.keys())
+
+        last = load_state(state_name)
+        save_state(state_name, {"timestamp": timestamp,
+                                "counters": self.current})
+
+        self.interval = int(timestamp) - int(last.get("timestamp", timestamp))
+        self.deltas = dict()
+        self._metrics = None
+        if self.interval <= 0:
+            self.interval = 0
+            return
+
+        deltas = defaultdict(dict)
+        for counter, values in self.current.iteritems():
+            previous = last["counters"].get(counter, dict())
+            for dev_id, value in values.iteritems():
+                before = previous.get(dev_id)
+                if before is None or value < before:
+                    continue
+                deltas[dev_id][counter] = value - before
+        self.deltas = dict(deltas)
+
+    @property
+    def metrics(self):
+        """ The element_metrics() of the deltas, worked out on first use """
+
+        if self._metrics is None:
+            self._metrics = element_metrics(self.interval, self.deltas)
+        return self._metrics
+
+
+def element_metrics(interval, deltas):
+    """ Turns counter deltas into IOPS, KBps, % utilization, response
+        time (ms) for each element """
+
+    metrics = dict()
+    for dev_id, delta in deltas.iteritems():
+        m = dict()
+        if "TotalIOs" in delta:
+            m["IOPS"] = delta["TotalIOs"] / float(interval)
+        if "KBytesTransferred" in delta:
+            m["KBps"] = delta["KBytesTransferred"] / float(interval)
+
+        busy = delta.get("IOTimeCounter")
+        idle = delta.get("IdleTimeCounter")
+        if busy is not None and idle is not None and busy + idle > 0:
+            m["Utilization"] = 100.0 * busy / (busy + idle)
+
+        ios = delta.get("ReadIOs", 0) + delta.get("WriteIOs", 0)
+        if "EMCSampledReadsTime" in delta and ios > 0:
+            # EMC sample times are given in microseconds
+            m["ResponseTime"] = (delta["EMCSampledReadsTime"] +
+                                 delta.get("EMCSampledWritesTime", 0)) / (
+                                 ios * 1000.0)
+
+        metrics[dev_id] = m
+
+    return metrics
+
+
+def percentile(values, pct):
+    """ Interpolated percentile of an already sorted list of values """
+
+    if len(values) == 1:
+        return values[0]
+
+    rank = (len(values) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+summary_counters = ["TotalIOs", "KBytesTransferred", "ReadIOs", "WriteIOs",
+                    "IOTimeCounter", "IdleTimeCounter",
+                    "EMCSampledReadsTime", "EMCSampledWritesTime"]
+summary_metrics = ["IOPS", "KBps", "Utilization", "ResponseTime"]
+
+
+def summary_stats(header_row, sample, array_serial, manifest_info, timestamp,
+                  top_n, element_info=None, allowed_ids=None):
+    """ Builds the array wide and per-SP distributions of each metric, the
+        elements are put under the SP owning them in element_info.  Only
+        the allowed_ids are summed up when given
+
+        Returns the summary (zabbix_key, value) tuples, the set of element
+        ids that made the top_n of any metric and the set of all of them """
+
+    metrics = sample.metrics
+    dev_ids = sample.dev_ids
+    if allowed_ids is not None:
+        metrics = dict((dev_id, m) for dev_id, m in metrics.iteritems()
+                       if dev_id in allowed_ids)
+        dev_ids = dev_ids & allowed_ids
+
+    results = []
+    top_ids = set()
+
+    owners = dict()
+    if element_info:
+        owners = dict((dev_id, getattr(element_info.get(dev_id), "owner",
+                                       None)) for dev_id in metrics)
+
+    for metric in summary_metrics:
+        scopes = defaultdict(list)
+        for dev_id, m in metrics.iteritems():
+            if metric not in m:
+                continue
+            scopes["Array"].append((m[metric], dev_id))
+            if owners.get(dev_id):
+                scopes[owners[dev_id]].append((m[metric], dev_id))
+
+        for scope, ranked in scopes.iteritems():
+            ranked.sort(reverse=True)
+            values = sorted([i[0] for i in ranked])
+
+            zabbix_key = "emc.vnx.summary.%s[%s,%s,%%s]" % (
+                metric, manifest_info, scope)
+            results.append((zabbix_key % "min", round(values[0], 3)))
+            results.append((zabbix_key % "avg",
+                            round(sum(values) / len(values), 3)))
+            results.append((zabbix_key % "max", round(values[-1], 3)))
+            for pct in summary_percentiles:
+                results.append((zabbix_key % ("p%d" % pct),
+                                round(percentile(values, pct), 3)))
+
+            top = ranked[:top_n]
+            top_ids.update([i[1] for i in top])
+            results.append((zabbix_key % "top", quote_value(", ".join(
+                ["%s=%.3f" % (dev_id, value) for value, dev_id in top]))))
+
+    return (results, top_ids, dev_ids)
+
+
+# Metrics scored against their baseline, and whether a drop is anomalous
+baseline_metrics = [("IOPS", True), ("KBps", True), ("Utilization", False),
+                    ("ResponseTime", False)]
+
+
+def anomaly_score(baseline, metrics):
+    """ Scores the metrics of an element against its baseline and folds
+        them into it, returning the score, None while warming up
+
+        baseline is [samples, mean, variance, mean, variance, ...] in the
+        order of baseline_metrics and is updated in place """
+
+    # Plain running averages until there are enough samples for the span
+    alpha = max(2.0 / (baseline_span + 1), 1.0 / (baseline[0] + 1))
+    warm = baseline[0] >= baseline_warmup
+    score = 0.0
+
+    for i, (metric, both_ways) in enumerate(baseline_metrics):
+        value = metrics.get(metric)
+        if value is None:
+            continue
+        mean, variance = baseline[1 + 2 * i:3 + 2 * i]
+        if mean is None:
+            baseline[1 + 2 * i:3 + 2 * i] = [value, 0.0]
+            continue
+
+        deviation = max(variance ** 0.5, anomaly_floor[metric])
+        z = (value - mean) / deviation
+        if both_ways:
+            z = abs(z)
+        if warm:
+            score = max(score, z)
+
+        # Once warm, anomalies are only let in up to the threshold, so an
+        # incident doesn't become the baseline right away
+        diff = value - mean
+        if warm:
+            limit = anomaly_threshold * deviation
+            diff = max(min(diff, limit), -limit)
+        mean += alpha * diff
+        variance = (1 - alpha) * (variance + alpha * diff * diff)
+        baseline[1 + 2 * i:3 + 2 * i] = [mean, variance]
+
+    baseline[0] += 1
+
+    if not warm:
+        return None
+    return round(score, 2)
+
+
+def anomaly_stats(header_row, sample, array_serial, timestamp,
+                  manifest_info=None, allowed_ids=None):
+    """ Yields an anomaly score for every element against its own baseline,
+        and how many elements are anomalous, only scoring the allowed_ids
+        when given """
+
+    if not sample.interval:
+        return
+
+    baseline_name = "%s_%s_baselines" % (array_serial, manifest_info)
+    baselines = load_state(baseline_name)
+    empty = [0] + [None] * (2 * len(baseline_metrics))
+
+    anomalous = 0
+    current = dict()
+    for dev_id, metrics in sample.metrics.iteritems():
+        if allowed_ids is not None and dev_id not in allowed_ids:
+            continue
+        baseline = baselines.get(dev_id, list(empty))
+        score = anomaly_score(baseline, metrics)
+        current[dev_id] = baseline
+        if score is None:
+            continue
+
+        if score > anomaly_threshold:
+            anomalous += 1
+        yield ("emc.vnx.perf.AnomalyScore[%s]" % dev_id, score)
+
+    # Elements without a delta this time (new, or their counters were
+    # reset) keep their baseline, only those that went away are dropped
+    for dev_id in sample.dev_ids:
+        if dev_id not in current and dev_id in baselines and \
+                (allowed_ids is None or dev_id in allowed_ids):
+            current[dev_id] = baselines[dev_id]
+    save_state(baseline_name, current)
+
+    yield ("emc.vnx.perf.AnomalousElements[%s]" % manifest_info, anomalous)
+
+
+def get_element_info(array_serial, ecom_ip, ecom_user, ecom_pass,
+                     element_type):
+    """ Returns the records of every volume or disk by performance id,
+        using the element cache kept by discovery where possible """
+
+    element_info = load_element_cache(array_serial, element_type)
+
+    if element_info is None:
+        ecom_conn = ecom_connect(ecom_ip, ecom_user, ecom_pass)
+        if element_type == "volume":
+            element_info = get_volume_info(ecom_conn, array_serial)
+        else:
+            element_info = get_disk_info(ecom_conn, array_serial)
+
+    return element_info
+
+
+# Counters summed per pool and per owning SP
+group_counters = ["TotalIOs", "KBytesTransferred", "ReadIOs", "KBytesRead",
+                  "WriteIOs", "KBytesWritten"]
+
+
+def group_stats(header_row, sample, array_serial, timestamp, element_info=None,
+                groups=[]):
+    """ Sums the group_counters of every element by each of the groups,
+        a list of (element record field, key prefix) tuples, returning the
+        totals along with IOPS and KBps rates from the summed deltas of the
+        elements since the last sample
+
+        A field of None totals every element into the "Array" group """
+
+    columns = [(i, sample.current[i]) for i in group_counters
+               if i in sample.current]
+    rates = {"TotalIOs": "IOPS", "KBytesTransferred": "KBps"}
+
+    totals = defaultdict(int)
+    changes = defaultdict(int)
+    for dev_id in sample.dev_ids:
+        element = None
+        if element_info:
+            element = element_info.get(dev_id)
+        delta = sample.deltas.get(dev_id, dict())
+        for field, prefix in groups:
+            if field is None:
+                group = "Array"
+            else:
+                group = getattr(element, field, None)
+            if group is None:
+                continue
+            for counter, values in columns:
+                if dev_id not in values:
+                    continue
+                totals["%s%s[%s]" % (prefix, counter, group)] += \
+                    values[dev_id]
+                if counter in rates and counter in delta:
+                    changes["%s%s[%s]" % (prefix, rates[counter], group)] += \
+                        delta[counter]
+
+    results = []
+    for key, value in totals.iteritems():
+        results.append(("emc.vnx.perf.%s" % key, value))
+
+    if not sample.interval:
+        return results
+
+    for key, value in changes.iteritems():
+        results.append(("emc.vnx.perf.%s" % key,
+                        round(value / float(sample.interval), 3)))
+
+    return results
 
 
 def sp_stats_query(array_serial, ecom_ip, ecom_user="admin",
@@ -231,8 +1232,120 @@ def sp_stats_query(array_serial, ecom_ip, ecom_user="admin",
     process_stats(header_row, stat_output, array_serial, "SP")
 
 
+def port_stats_query(array_serial, ecom_ip, ecom_user="admin",
+                     ecom_pass="#1Password"):
+    """ Front-end port stats, from the same pull as the SP stats """
+
+    InstanceID = stat_manifest_info["Ports"]["InstanceID"]
+
+    header_row, stat_output = get_stats(array_serial, ecom_ip, InstanceID,
+                                        ecom_user, ecom_pass)
+
+    process_stats(header_row, stat_output, array_serial, "Ports")
+
+
+# The snapshot values the template has items for
+snapshot_keys = ["emc.vnx.perf.SnapIOPS[Array]",
+                 "emc.vnx.perf.SnapKBps[Array]"]
+
+
+def snapshot_totals(header_row, sample, array_serial, timestamp):
+    """ Yields the array wide snapshot IOPS and KBps """
+
+    for zabbix_key, value in group_stats(header_row, sample, array_serial,
+                                         timestamp, groups=[(None, "Snap")]):
+        if zabbix_key in snapshot_keys:
+            yield (zabbix_key, value)
+
+
+def snapshot_stats_query(array_serial, ecom_ip, ecom_user="admin",
+                         ecom_pass="#1Password"):
+    """ Array wide snapshot IO rates, snapshots aren't discovered so their
+        own counters are not sent """
+
+    InstanceID = stat_manifest_info["Snapshots"]["InstanceID"]
+
+    header_row, stat_output = get_stats(array_serial, ecom_ip, InstanceID,
+                                        ecom_user, ecom_pass)
+
+    skip_fields = [i for i in header_row or []
+                   if i not in ["ElementType", "StatisticTime", "InstanceID"]]
+
+    process_stats(header_row, stat_output, array_serial, "Snapshots",
+                  skip_fields, [snapshot_totals])
+
+
+# Per-SP volume counters, in the order sp_balance_stats() unpacks them
+balance_counters = ["EMCSPAReadIOs", "EMCSPAWriteIOs", "EMCSPBReadIOs",
+                    "EMCSPBWriteIOs", "EMCKBytesSPARead",
+                    "EMCKBytesSPAWritten", "EMCKBytesSPBRead",
+                    "EMCKBytesSPBWritten", "EMCImplicitTresspasses",
+                    "EMCExplicitTresspasses"]
+
+
+def sp_balance_stats(header_row, sample, array_serial, timestamp,
+                     element_info=None):
+    """ Works out from the per-SP counter deltas of every volume the share
+        of its IOs going through the SP that doesn't own it, and the load
+        split and trespasses of all the volumes between the SPs """
+
+    if not sample.interval or \
+            not all(i in sample.current for i in balance_counters):
+        return
+
+    totals = defaultdict(int)
+    for dev_id, delta in sample.deltas.iteritems():
+        values = [delta.get(i) for i in balance_counters]
+        if None in values:
+            continue
+        (spa_read, spa_write, spb_read, spb_write, spa_kb_read,
+         spa_kb_written, spb_kb_read, spb_kb_written, implicit,
+         explicit) = values
+
+        ios = {"SPA": spa_read + spa_write, "SPB": spb_read + spb_write}
+        totals["IOs", "SPA"] += ios["SPA"]
+        totals["IOs", "SPB"] += ios["SPB"]
+        totals["KB", "SPA"] += spa_kb_read + spa_kb_written
+        totals["KB", "SPB"] += spb_kb_read + spb_kb_written
+        totals["ImplicitTrespasses"] += implicit
+        totals["ExplicitTrespasses"] += explicit
+
+        owner = getattr(element_info.get(dev_id), "owner", None) \
+            if element_info else None
+        volume_ios = ios["SPA"] + ios["SPB"]
+        if owner not in ios or not volume_ios:
+            continue
+
+        non_owner = volume_ios - ios[owner]
+        ratio = 100.0 * non_owner / volume_ios
+        totals["OwnedIOs"] += volume_ios
+        totals["NonOwnerIOs"] += non_owner
+        if ratio > non_owner_threshold:
+            totals["NonOwnerVolumes"] += 1
+
+        yield ("emc.vnx.perf.VolNonOwnerIORatio[%s]" % dev_id,
+               round(ratio, 2))
+
+    for unit, prefix in [("IOs", "SPVolIOShare"), ("KB", "SPVolKBShare")]:
+        total = totals[unit, "SPA"] + totals[unit, "SPB"]
+        if not total:
+            continue
+        for sp in ["SPA", "SPB"]:
+            yield ("emc.vnx.perf.%s[%s]" % (prefix, sp),
+                   round(100.0 * totals[unit, sp] / total, 2))
+
+    if totals["OwnedIOs"]:
+        yield ("emc.vnx.perf.VolNonOwnerIORatio[Array]",
+               round(100.0 * totals["NonOwnerIOs"] / totals["OwnedIOs"], 2))
+    yield ("emc.vnx.perf.NonOwnerVolumes[Array]", totals["NonOwnerVolumes"])
+    yield ("emc.vnx.perf.VolImplicitTrespasses[Array]",
+           totals["ImplicitTrespasses"])
+    yield ("emc.vnx.perf.VolExplicitTrespasses[Array]",
+           totals["ExplicitTrespasses"])
+
+
 def volume_stats_query(array_serial, ecom_ip, ecom_user="admin",
-                       ecom_pass="#1Password"):
+                       ecom_pass="#1Password", top_n=None, filters=None):
 
     InstanceID = stat_manifest_info["Volumes"]["InstanceID"]
 
@@ -260,13 +1373,79 @@ def volume_stats_query(array_serial, ecom_ip, ecom_user="admin",
                    "EMCReadHistogram", "EMCReadHistogramOverflows",
                    "EMCWriteHistogram", "EMCWriteHistogramOverflows"]
 
+    volume_info = get_element_info(array_serial, ecom_ip, ecom_user,
+                                   ecom_pass, "volume")
+    allowed_ids = None
+    if filters:
+        allowed_ids = filter_elements(volume_info, filters)
+
+    # Pool and SP owner totals are summed up, the per-SP counters checked
+    # against the owner and the volumes scored against their baselines in
+    # the same pass
+    processors = [partial(group_stats, element_info=volume_info,
+                          groups=[("pool_id", "PoolVol"),
+                                  ("owner", "OwnedVol")]),
+                  partial(sp_balance_stats, element_info=volume_info),
+                  partial(anomaly_stats, manifest_info="Volumes",
+                          allowed_ids=allowed_ids)]
+
     process_stats(header_row, stat_output, array_serial, "Volumes",
-                  skip_fields)
+                  skip_fields, processors, top_n, allowed_ids, volume_info)
+
+
+# Disk counters rolled up per back-end bus and enclosure
+location_counters = ["TotalIOs", "KBytesTransferred", "IOTimeCounter",
+                     "IdleTimeCounter", "EMCQueueLength", "EMCQueueArrivals"]
+
+
+def location_stats(header_row, sample, array_serial, timestamp,
+                   element_info=None):
+    """ Rolls the disk deltas up to each back-end bus and enclosure, IOPS
+        and KBps are summed, utilization is the average and the highest of
+        the disks, queue length the average length seen on arrival """
+
+    interval = sample.interval
+    if not interval or not element_info:
+        return
+
+    groups = defaultdict(lambda: defaultdict(int))
+    for dev_id, delta in sample.deltas.iteritems():
+        disk = element_info.get(dev_id)
+        if disk is None:
+            continue
+
+        for group in [("Bus", disk.bus), ("Enclosure", disk.enclosure)]:
+            totals = groups[group]
+            for counter in location_counters:
+                if counter in delta:
+                    totals[counter] += delta[counter]
+
+            busy = delta.get("IOTimeCounter")
+            idle = delta.get("IdleTimeCounter")
+            if busy is not None and idle is not None and busy + idle > 0:
+                utilization = 100.0 * busy / (busy + idle)
+                totals["Utilization"] += utilization
+                totals["UtilizationDisks"] += 1
+                totals["MaxUtilization"] = max(totals["MaxUtilization"],
+                                               utilization)
+
+    for (prefix, group_id), totals in groups.iteritems():
+        key = "emc.vnx.perf.%sDisk%%s[%s]" % (prefix, group_id)
+        yield (key % "IOPS", round(totals["TotalIOs"] / float(interval), 3))
+        yield (key % "KBps",
+               round(totals["KBytesTransferred"] / float(interval), 3))
+        if totals["UtilizationDisks"]:
+            yield (key % "Utilization", round(
+                totals["Utilization"] / totals["UtilizationDisks"], 3))
+            yield (key % "MaxUtilization", round(totals["MaxUtilization"], 3))
+        if totals["EMCQueueArrivals"]:
+            yield (key % "QueueLength", round(
+                totals["EMCQueueLength"] / float(totals["EMCQueueArrivals"]),
+                3))
 
-    # Calculate our response times
 
 def disk_stats_query(array_serial, ecom_ip, ecom_user="admin",
-                     ecom_pass="#1Password"):
+                     ecom_pass="#1Password", top_n=None, filters=None):
 
     InstanceID = stat_manifest_info["Disks"]["InstanceID"]
 
@@ -276,7 +1455,22 @@ def disk_stats_query(array_serial, ecom_ip, ecom_user="admin",
     skip_fields = ["EMCSpinUPS", "EMCCurrentPWRSavingLogTimeStamp",
                    "EMCSpinningCounter", "EMCStandbyCounter"]
 
-    process_stats(header_row, stat_output, array_serial, "Disks", skip_fields)
+    disk_info = get_element_info(array_serial, ecom_ip, ecom_user,
+                                 ecom_pass, "disk")
+    allowed_ids = None
+    if filters:
+        allowed_ids = filter_elements(disk_info, filters)
+
+    # Pool totals, bus and enclosure rollups and anomaly scores come from
+    # the same pass
+    processors = [partial(group_stats, element_info=disk_info,
+                          groups=[("pool_id", "PoolDisk")]),
+                  partial(location_stats, element_info=disk_info),
+                  partial(anomaly_stats, manifest_info="Disks",
+                          allowed_ids=allowed_ids)]
+
+    process_stats(header_row, stat_output, array_serial, "Disks", skip_fields,
+                  processors, top_n, allowed_ids, disk_info)
 
 
 def pool_stats_query(array_serial, ecom_ip, ecom_user="admin",
@@ -303,29 +1497,211 @@ def pool_stats_query(array_serial, ecom_ip, ecom_user="admin",
     zabbix_data = []
     timestamp = datetime.now().strftime("%s")
 
+    state_name = "%s_pool_forecast" % array_serial
+    forecasts = load_state(state_name)
+
     for pool_class in pool_classes:
         for i in ecom_conn.Associators(array, ResultClass=pool_class):
+            pool_id = i["InstanceID"].replace(" ", "_")
             for stat in processed_stats:
                 try:
-                    zabbix_key = "emc.vnx.perf.%s[%s]" % (
-                        stat, i["InstanceID"].replace(" ", "_"))
-                    zabbix_data.append("%s %s %s %s" % (array_serial,
-                                                        zabbix_key,
-                                                        timestamp,
-                                                        i[stat]))
+                    zabbix_key = "emc.vnx.perf.%s[%s]" % (stat, pool_id)
+                    zabbix_data.append((zabbix_key, i[stat]))
                 except KeyError:
                     pass
 
-    stat_file = "/tmp/pool_data.tmp"
-
-    with open(stat_file, "w") as f:
-        f.write("\n".join(zabbix_data))
-
-    subprocess.call([sender_command, "-v", "-c", config_path,
-                    "-s", array_serial, "-T", "-i", stat_file])
+            try:
+                total = i["TotalManagedSpace"]
+                consumed = total - i["RemainingManagedSpace"]
+                subscribed = i["EMCSubscribedCapacity"] or 0
+            except (KeyError, TypeError):
+                continue
 
-    print "\n".join(zabbix_data)
-    print "\n"
+            fit = update_forecast(forecasts.get(pool_id), int(timestamp),
+                                  consumed, subscribed)
+            forecasts[pool_id] = fit
+            zabbix_data.extend(forecast_values(pool_id, fit, total,
+                                               consumed))
+
+    save_state(state_name, forecasts)
+
+    stat_file = os.path.join(state_dir, "%s_pool_data.tmp" % array_serial)
+
+    send_values(array_serial,
+                format_values(array_serial, timestamp, zabbix_data),
+                stat_file)
+
+
+def update_forecast(fit, timestamp, consumed, subscribed):
+    """ Adds a capacity sample to the regression state of a pool, a handful
+        of exponentially decayed sums, so no history is kept or scanned """
+
+    if fit is None:
+        fit = {"origin": timestamp, "last": timestamp, "w": 0.0, "x": 0.0,
+               "xx": 0.0, "c": 0.0, "xc": 0.0, "s": 0.0, "xs": 0.0}
+    elif timestamp <= fit["last"]:
+        return fit
+
+    # Older samples fade out, so the trend follows changes in growth
+    decay = 0.5 ** ((timestamp - fit["last"]) / 86400.0 / forecast_half_life)
+    for i in ("w", "x", "xx", "c", "xc", "s", "xs"):
+        fit[i] *= decay
+
+    x = (timestamp - fit["origin"]) / 86400.0   # in days
+    fit["w"] += 1
+    fit["x"] += x
+    fit["xx"] += x * x
+    fit["c"] += consumed
+    fit["xc"] += x * consumed
+    fit["s"] += subscribed
+    fit["xs"] += x * subscribed
+    fit["last"] = timestamp
+
+    return fit
+
+
+def forecast_slope(fit, y, xy):
+    """ Returns the per day growth of the weighted least squares fit, None
+        until the samples span forecast_min_span days """
+
+    spread = fit["w"] * fit["xx"] - fit["x"] * fit["x"]
+    if spread <= 0 or \
+            fit["last"] - fit["origin"] < forecast_min_span * 86400:
+        return None
+
+    return (fit["w"] * fit[xy] - fit["x"] * fit[y]) / spread
+
+
+def forecast_values(pool_id, fit, total, consumed):
+    """ Yields the growth and time to full of a pool from its regression """
+
+    consumed_growth = forecast_slope(fit, "c", "xc")
+    if consumed_growth is None:
+        return
+
+    yield ("emc.vnx.perf.PoolConsumedGrowth[%s]" % pool_id,
+           int(consumed_growth))
+    yield ("emc.vnx.perf.PoolSubscribedGrowth[%s]" % pool_id,
+           int(forecast_slope(fit, "s", "xs")))
+
+    days = forecast_horizon
+    if consumed_growth > 0:
+        days = min(max(total - consumed, 0) / consumed_growth,
+                   forecast_horizon)
+
+    yield ("emc.vnx.perf.PoolTimeToFull[%s]" % pool_id, int(days * 86400))
+
+
+# Hardware health severity, matches the "EMC VNX Health Status" value map
+STATUS_OK = 0
+STATUS_UNKNOWN = 1
+STATUS_WARNING = 2      # Degraded, still serving IO
+STATUS_ERROR = 3
+STATUS_CRITICAL = 4     # Failed or unreachable
+
+# CIM_ManagedSystemElement OperationalStatus values
+operational_severity = {0: STATUS_UNKNOWN,      # Unknown
+                        1: STATUS_UNKNOWN,      # Other
+                        2: STATUS_OK,           # OK
+                        3: STATUS_WARNING,      # Degraded
+                        4: STATUS_WARNING,      # Stressed
+                        5: STATUS_WARNING,      # Predictive Failure
+                        6: STATUS_ERROR,        # Error
+                        7: STATUS_CRITICAL,     # Non-Recoverable Error
+                        8: STATUS_WARNING,      # Starting
+                        9: STATUS_WARNING,      # Stopping
+                        10: STATUS_ERROR,       # Stopped
+                        11: STATUS_OK,          # In Service
+                        12: STATUS_CRITICAL,    # No Contact
+                        13: STATUS_CRITICAL,    # Lost Communication
+                        14: STATUS_ERROR,       # Aborted
+                        15: STATUS_OK,          # Dormant
+                        16: STATUS_ERROR,       # Supporting Entity in Error
+                        17: STATUS_OK,          # Completed
+                        18: STATUS_OK}          # Power Mode
+
+# EMC specific OperationalStatus values (32768 and up) are judged by their
+# matching StatusDescriptions entry
+description_severity = {"ok": STATUS_OK, "online": STATUS_OK,
+                        "ready": STATUS_OK, "enabled": STATUS_OK,
+                        "present": STATUS_OK, "empty": STATUS_OK,
+                        "unbound": STATUS_OK, "hot spare ready": STATUS_OK,
+                        "equalizing": STATUS_WARNING,
+                        "rebuilding": STATUS_WARNING,
+                        "transitioning": STATUS_WARNING,
+                        "powering up": STATUS_WARNING,
+                        "removed": STATUS_CRITICAL,
+                        "faulted": STATUS_CRITICAL,
+                        "failed": STATUS_CRITICAL}
+
+
+def status_severity(operational_status, descriptions):
+    """ Returns the worst STATUS_* severity of a device from its
+        OperationalStatus and StatusDescriptions lists """
+
+    operational_status = operational_status or []
+    descriptions = descriptions or []
+
+    severities = []
+    for index, value in enumerate(operational_status):
+        value = int(value)
+        if value in operational_severity:
+            severities.append(operational_severity[value])
+        elif index < len(descriptions):
+            severities.append(description_severity.get(
+                descriptions[index].strip().lower(), STATUS_UNKNOWN))
+        else:
+            severities.append(STATUS_UNKNOWN)
+
+    if not severities:
+        # No OperationalStatus, fall back to the text alone
+        severities = [description_severity.get(i.strip().lower(),
+                                               STATUS_UNKNOWN)
+                      for i in descriptions]
+
+    if not severities:
+        return STATUS_UNKNOWN
+
+    return max(severities)
+
+
+def device_record(device_id, inst):
+    """ Returns a DeviceRecord with the status severity and detail text,
+        inst is a CIMInstance or a dict from AssociatorProperties """
+
+    props = emc_vnx_ecom.instance_properties(inst, ["OperationalStatus",
+                                                    "StatusDescriptions"])
+    descriptions = props["StatusDescriptions"] or []
+
+    return DeviceRecord(device_id=device_id,
+                        status=status_severity(props["OperationalStatus"],
+                                               descriptions),
+                        detail=" ".join(descriptions))
+
+
+def health_values(array_serial, timestamp, devices):
+    """ Yields the severity of every device, and the status text of the
+        devices whose text changed since it was last sent """
+
+    state_name = "%s_health" % array_serial
+    last = load_state(state_name)
+    refresh = int(timestamp) - int(last.get("timestamp", 0)) >= \
+        health_detail_refresh
+    last_details = last.get("details", dict())
+
+    details = dict()
+    for device in devices:
+        yield ("emc.vnx.health.Status[%s]" % device.device_id, device.status)
+
+        details[device.device_id] = device.detail
+        if refresh or last_details.get(device.device_id) != device.detail:
+            yield ("emc.vnx.health.StatusDetail[%s]" % device.device_id,
+                   quote_value(device.detail))
+
+    if refresh:
+        last["timestamp"] = timestamp
+    last["details"] = details
+    save_state(state_name, last)
 
 
 def hardware_healthcheck(array_serial, ecom_ip, ecom_user="admin",
@@ -335,7 +1711,7 @@ def hardware_healthcheck(array_serial, ecom_ip, ecom_user="admin",
 
     # Generate our timestamp
     timestamp = datetime.now().strftime("%s")
-    zabbix_data = []
+    devices = []
 
     # Lets locate our array
     array_list = ecom_conn.EnumerateInstanceNames("Clar_StorageSystem")
@@ -353,7 +1729,6 @@ def hardware_healthcheck(array_serial, ecom_ip, ecom_user="admin",
     for device in health_classes:
         dev_instance = ecom_conn.Associators(array, ResultClass=device)
         for inst in dev_instance:
-            status = " ".join(inst["StatusDescriptions"])
             if "DiskDrive" in device:
                 device_id = inst["SystemName"] + "+" + inst["Name"]
             elif "StorageProcessor" in device:
@@ -361,9 +1736,7 @@ def hardware_healthcheck(array_serial, ecom_ip, ecom_user="admin",
             else:
                 device_id = inst["DeviceID"]
 
-            zabbix_key = "emc.vnx.health.Status[%s]" % device_id
-            zabbix_data.append("%s %s %s %s" % (array_serial, zabbix_key,
-                                                timestamp, status))
+            devices.append(device_record(device_id, inst))
 
     # For enclosures we need to locate the ArrayChassis
     chassis_list = ecom_conn.EnumerateInstanceNames("EMC_ArrayChassis")
@@ -378,22 +1751,15 @@ def hardware_healthcheck(array_serial, ecom_ip, ecom_user="admin",
                                        ResultClass="EMC_EnclosureChassis")
 
     for inst in enclosures:
-        status = " ".join(inst["StatusDescriptions"])
-        device_id = inst["Tag"]
-        zabbix_key = "emc.vnx.health.Status[%s]" % device_id
-        zabbix_data.append("%s %s %s %s" % (array_serial, zabbix_key,
-                                            timestamp, status))
-
-    stat_file = "/tmp/health_data.tmp"
+        devices.append(device_record(inst["Tag"], inst))
 
-    with open(stat_file, "w") as f:
-        f.write("\n".join(zabbix_data))
+    stat_file = os.path.join(state_dir, "%s_health_data.tmp" % array_serial)
 
-    subprocess.call([sender_command, "-v", "-c", config_path,
-                    "-s", array_serial, "-T", "-i", stat_file])
-
-    print "\n".join(zabbix_data)
-    print "\n"
+    send_values(array_serial,
+                format_values(array_serial, timestamp,
+                              health_values(array_serial, timestamp,
+                                            devices)),
+                stat_file)
 
 
 def get_pool_io_stats(ecom_conn, array, disk_id_list, vol_id_list):
@@ -427,8 +1793,8 @@ def get_pool_io_stats(ecom_conn, array, disk_id_list, vol_id_list):
             StatisticsFormat=pywbem.Uint16(2),
             ElementTypes=[pywbem.Uint16(8), pywbem.Uint16(10)])
 
-    disk_stat = StringIO.StringIO(cim_stats[1]["Statistics"][0])  # Disk stats
-    vol_stat = StringIO.StringIO(cim_stats[1]["Statistics"][1])  # Vol Stats
+    disk_stat = iter_lines(cim_stats[1]["Statistics"][0])  # Disk stats
+    vol_stat = iter_lines(cim_stats[1]["Statistics"][1])  # Vol Stats
 
     # The parameters we care about
     pool_stats = ["TotalIOs", "KBytesTransferred", "ReadIOs", "KBytesRead",
@@ -495,12 +1861,12 @@ def pool_performance(req_pool, array_serial, ecom_ip,
     for pool in pools:
         if array_pool in pool["InstanceID"]:
 
-            pool_disks = ecom_conn.Associators(
-                pool, AssocClass="CIM_ConcreteDependency",
+            pool_disks = ecom_conn.AssociatorProperties(
+                pool, ["Name"], AssocClass="CIM_ConcreteDependency",
                 ResultClass="CIM_DiskDrive")
 
-            pool_volumes = ecom_conn.Associators(
-                pool, ResultClass="CIM_StorageVolume")
+            pool_volumes = ecom_conn.AssociatorProperties(
+                pool, ["EMCBSPInstanceID"], ResultClass="CIM_StorageVolume")
 
             disk_list = []
             for i in pool_disks:
@@ -516,15 +1882,11 @@ def pool_performance(req_pool, array_serial, ecom_ip,
             timestamp = stats["timestamp"]
             for i in stats["disks"].keys():
                 zabbix_key = "emc.vnx.perf.PoolDisk%s[%s]" % (i, req_pool)
-                zabbix_data.append("%s %s %s %s" % (array_serial, zabbix_key,
-                                                    timestamp,
-                                                    str(stats["disks"][i])))
+                zabbix_data.append((zabbix_key, stats["disks"][i]))
 
             for i in stats["volumes"].keys():
                 zabbix_key = "emc.vnx.perf.PoolVol%s[%s]" % (i, req_pool)
-                zabbix_data.append("%s %s %s %s" % (array_serial, zabbix_key,
-                                                    timestamp,
-                                                    str(stats["volumes"][i])))
+                zabbix_data.append((zabbix_key, stats["volumes"][i]))
 
     print "------------------------------------------------------"
     current_time = datetime.now().strftime("%c")
@@ -534,22 +1896,17 @@ def pool_performance(req_pool, array_serial, ecom_ip,
     # Check if we've already collected and sent this dataset
     last_stat = None
 
-    last_file = "/tmp/poolperf_%s_last.tmp" % req_pool
-    stat_file = "/tmp/poolperf_%s_data.tmp" % req_pool
+    last_file = os.path.join(state_dir, "poolperf_%s_last.tmp" % req_pool)
+    stat_file = os.path.join(state_dir, "poolperf_%s_data.tmp" % req_pool)
 
     if os.path.isfile(last_file):
         with open(last_file) as f:
             last_stat = f.readline()
 
     if timestamp != last_stat:
-        with open(stat_file, "w") as f:
-            f.write("\n".join(zabbix_data))
-
-        subprocess.call([sender_command, "-v", "-c", config_path,
-                         "-s", array_serial, "-T", "-i", stat_file])
-
-        print "\n".join(zabbix_data)
-        print "\n"
+        send_values(array_serial,
+                    format_values(array_serial, timestamp, zabbix_data),
+                    stat_file)
 
         with open(last_file, "w") as f:
             f.write(timestamp)
@@ -559,6 +1916,18 @@ def pool_performance(req_pool, array_serial, ecom_ip,
 
     print "------------------------------------------------------\n"
 
+def send_ecom_health(array_serial, ecom_ip):
+    """ Reports the ECOM health state for the array to Zabbix """
+
+    health = emc_vnx_ecom.ecom_health(ecom_ip)
+    timestamp = datetime.now().strftime("%s")
+
+    send_values(array_serial,
+                format_values(array_serial, timestamp,
+                              [("emc.vnx.ecom.Health", health)]),
+                os.path.join(state_dir, "%s_ecom_data.tmp" % array_serial))
+
+
 def log_exception_handler(type, value, tb):
     logger = logging.getLogger('discovery')
     logger.exception("Uncaught exception: {0}".format(str(value)))
@@ -581,8 +1950,104 @@ def setup_logging(log_file):
 
     return
 
+def run_mode(args, array_serial):
+    """ Runs the collection mode selected by args against one array """
+
+    if args.disks:
+        disk_stats_query(array_serial, args.ecom_ip,
+                         args.ecom_user, args.ecom_pass, args.top,
+                         filters_from_args(args))
+    elif args.volumes:
+        volume_stats_query(array_serial, args.ecom_ip,
+                           args.ecom_user, args.ecom_pass, args.top,
+                           filters_from_args(args))
+    elif args.procs:
+        sp_stats_query(array_serial, args.ecom_ip,
+                       args.ecom_user, args.ecom_pass)
+    elif args.ports:
+        port_stats_query(array_serial, args.ecom_ip,
+                         args.ecom_user, args.ecom_pass)
+    elif args.snaps:
+        snapshot_stats_query(array_serial, args.ecom_ip,
+                             args.ecom_user, args.ecom_pass)
+    elif args.pools:
+        pool_stats_query(array_serial, args.ecom_ip,
+                         args.ecom_user, args.ecom_pass)
+    elif args.array:
+        hardware_healthcheck(array_serial, args.ecom_ip,
+                             args.ecom_user, args.ecom_pass)
+    elif args.poolperf:
+        pool_performance(args.poolperf, array_serial, args.ecom_ip,
+                         args.ecom_user, args.ecom_pass)
+
+
+def replay_archive(args, mode):
+    """ Streams the archived samples of the --replay time range back
+        through the collection, keeping the state and sender files of the
+        replay apart so the live collection is left alone """
+
+    global state_dir, replay_pull
+
+    start = emc_vnx_archive.parse_time(args.replay[0])
+    end = emc_vnx_archive.parse_time(args.replay[1])
+
+    for array_serial in args.serial:
+        state_dir = os.path.join(emc_vnx_archive.array_dir(array_serial),
+                                 "replay_%s" % mode)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        samples = 0
+        for timestamp, sequences, statistics in \
+                emc_vnx_archive.read_samples(array_serial, start, end):
+            replay_pull = {"fetched": time.time(), "sequences": sequences,
+                           "statistics": statistics}
+            run_mode(args, array_serial)
+            samples += 1
+
+        print "Replayed %d samples of %s" % (samples, array_serial)
+
+    replay_pull = None
+
+
+def collect_array(args, array_serial, mode, manifest_info):
+    """ Runs the collection for one array under its run lock, returns False
+        when it ran out of time and should carry on in the background """
+
+    logger = logging.getLogger('discovery')
+
+    # Only one run per array and mode, a background run waits its turn
+    run_lock = acquire_run_lock(array_serial, mode, args.no_deadline)
+    if run_lock is None:
+        logger.info("%s collection already running for %s" % (mode,
+                                                               array_serial))
+        print "Collection already running"
+        if manifest_info:
+            print_last_run(array_serial, manifest_info)
+        return True
+
+    try:
+        run_mode(args, array_serial)
+    except (ECOMUnavailable, PullLockTimeout), e:
+        logger.warning(str(e))
+        print str(e)
+    except DeadlineExceeded, e:
+        logger.warning(str(e))
+        print str(e)
+        if manifest_info:
+            print_last_run(array_serial, manifest_info)
+        return False
+    finally:
+        run_lock.close()
+        send_ecom_health(array_serial, args.ecom_ip)
+
+    return True
+
+
 def main():
-   
+
+    global quiet, sender, sender_batch_size, sender_concurrency, no_send
+
     log_file = '/tmp/emc_vnx_stats.log'
     setup_logging(log_file)
 
@@ -590,15 +2055,46 @@ def main():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--serial', '-s', action="store",
-                        help="Array Serial Number", required=True)
+    parser.add_argument('--serial', '-s', action="append",
+                        help="Array Serial Number, repeat it to collect "
+                             "several arrays of the ECOM in one run",
+                        required=True)
     parser.add_argument('--ecom_ip', '-i', action="store",
-                        help="IP Address of ECOM server", required=True)
+                        help="IP Address of ECOM server, or several ECOM "
+                             "endpoints separated by spaces", required=True)
 
     parser.add_argument('--ecom_user', action="store",
                         help="ECOM Username", default="admin")
     parser.add_argument('--ecom_pass', action="store",
                         help="ECOM Password", default="#1Password")
+    parser.add_argument('--top', '-t', action="store", type=int,
+                        help="Summary mode for disks and volumes, only send "
+                             "distributions and the TOP busiest elements")
+    add_filter_arguments(parser)
+    emc_vnx_ecom.add_ecom_arguments(parser)
+    parser.add_argument('--timeout', action="store", type=float, default=30,
+                        help="Seconds Zabbix waits for the script, should "
+                             "match Timeout in zabbix_server.conf")
+    parser.add_argument('--no_deadline', action="store_true",
+                        help="Run to completion, used for background runs")
+    parser.add_argument('--quiet', '-q', action="store_true",
+                        help="Don't echo every value sent to stdout")
+    parser.add_argument('--background', '-b', action="store_true",
+                        help="Start the collection in the background and "
+                             "return the status of the last completed run")
+    parser.add_argument('--batch_size', action="store", type=int,
+                        default=sender_batch_size,
+                        help="Most values sent by each zabbix_sender")
+    parser.add_argument('--send_concurrency', action="store", type=int,
+                        default=sender_concurrency,
+                        help="zabbix_sender runs in flight at once")
+    parser.add_argument('--replay', action="store", nargs=2,
+                        metavar=("START", "END"),
+                        help="Run the archived samples from START to END "
+                             "(epoch or \"YYYY-MM-DD HH:MM\") through the "
+                             "collection instead of pulling from the ECOM")
+    parser.add_argument('--no_send', action="store_true",
+                        help="Only print the values, don't send them")
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--disks', '-d', action="store_true",
@@ -607,6 +2103,10 @@ def main():
                        help="Collect Stats on Volumes/LUNs")
     group.add_argument('--procs', '-p', action="store_true",
                        help="Collect Stats on Storage Processors")
+    group.add_argument('--ports', '-f', action="store_true",
+                       help="Collect Stats on Front-end Ports")
+    group.add_argument('--snaps', '-n', action="store_true",
+                       help="Collect Stats on Snapshots")
     group.add_argument('--pools', '-o', action="store_true",
                        help="Collect Stats on Physical Disks")
     group.add_argument('--array', '-a', action="store_true",
@@ -616,6 +2116,12 @@ def main():
 
     args = parser.parse_args()
     logger.debug("Arguments parsed: %s" % str(args))
+    emc_vnx_ecom.configure(args)
+
+    quiet = args.quiet
+    no_send = args.no_send
+    sender_batch_size = args.batch_size
+    sender_concurrency = args.send_concurrency
 
     # Check for zabbix_sender and agentd files
     if not os.path.isfile(sender_command):
@@ -632,30 +2138,66 @@ def main():
         print "Please update the script with the appropriate path"
         sys.exit()
 
-    if args.disks:
-        disk_stats_query(args.serial, args.ecom_ip,
-                         args.ecom_user, args.ecom_pass)
-        sys.exit()
-    elif args.volumes:
-        volume_stats_query(args.serial, args.ecom_ip,
-                           args.ecom_user, args.ecom_pass)
-        sys.exit()
-    elif args.procs:
-        sp_stats_query(args.serial, args.ecom_ip,
-                       args.ecom_user, args.ecom_pass)
-        sys.exit()
-    elif args.pools:
-        pool_stats_query(args.serial, args.ecom_ip,
-                         args.ecom_user, args.ecom_pass)
+    if args.poolperf:
+        mode = "poolperf_%s" % args.poolperf
+    else:
+        mode = [i for i in ["disks", "volumes", "procs", "ports", "snaps",
+                            "pools", "array"] if getattr(args, i)][0]
+    manifest_info = {"disks": "Disks", "volumes": "Volumes",
+                     "procs": "SP", "ports": "Ports",
+                     "snaps": "Snapshots"}.get(mode)
+
+    if args.replay:
+        if not manifest_info:
+            parser.error("--replay needs one of the statistics modes")
+        if not emc_vnx_archive.archive_dir:
+            parser.error("archive_dir is not set in emc_vnx_archive.py")
+        replay_archive(args, mode)
         sys.exit()
-    elif args.array:
-        hardware_healthcheck(args.serial, args.ecom_ip,
-                             args.ecom_user, args.ecom_pass)
-    elif args.poolperf:
-        pool_performance(args.poolperf, args.serial, args.ecom_ip,
-                         args.ecom_user, args.ecom_pass)
+
+    # The background job sends its values through the trapper by itself,
+    # the external check only reports on it
+    if args.background:
+        idle = []
+        for array_serial in args.serial:
+            # Only one run per array and mode, the job waits its turn
+            run_lock = acquire_run_lock(array_serial, mode)
+            if run_lock is not None:
+                run_lock.close()
+                idle.append(array_serial)
+
+        if idle:
+            spawn_background()
+        for array_serial in args.serial:
+            if array_serial in idle:
+                print "Collection started"
+            else:
+                print "Collection already running"
+            if manifest_info:
+                print_last_run(array_serial, manifest_info)
         sys.exit()
 
+    if not args.no_deadline:
+        set_deadline(args.timeout)
+
+    # Several arrays share their sender batches
+    if len(args.serial) > 1:
+        sender = SenderBatches(os.path.join(state_dir,
+                                            "emc_vnx_%s_data.tmp" % mode))
+
+    for array_serial in args.serial:
+        if not collect_array(args, array_serial, mode, manifest_info):
+            # Out of time, the background run picks up every array again
+            # and skips the datasets already sent
+            if sender is not None:
+                sender.close()
+                sender = None
+            spawn_background()
+            break
+
+    if sender is not None:
+        sender.close()
+
 
 if __name__ == "__main__":
     main()
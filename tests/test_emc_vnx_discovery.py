@@ -0,0 +1,85 @@
+#!/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import pywbem
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import emc_vnx_ecom
+import emc_vnx_discovery
+
+serial = "APM00000000001"
+
+
+class FakeWBEMConnection(object):
+    """ Answers with real CIMInstanceNames and CIMInstances of one array
+        with a single SP, as pywbem 0.7 returns them """
+
+    def __init__(self, ports):
+        self.ports = ports
+
+    def EnumerateInstanceNames(self, ClassName):
+        return [pywbem.CIMInstanceName(
+            "Clar_StorageSystem", {"Name": "CLARiiON+%s" % serial})]
+
+    def AssociatorNames(self, ObjectName, **kwargs):
+        return [pywbem.CIMInstanceName(
+            "EMC_StorageProcessorSystem",
+            {"Name": "CLARiiON+%s_SP_A" % serial})]
+
+    def Associators(self, ObjectName, ResultClass=None, **kwargs):
+        return self.ports.get(ResultClass, [])
+
+
+def port(device_id, perf_id=None, number=None, name=None):
+    properties = {"DeviceID": device_id}
+    if perf_id is not None:
+        properties["EMCBSPInstanceID"] = perf_id
+    if number is not None:
+        properties["PortNumber"] = pywbem.Uint16(number)
+    if name is not None:
+        properties["ElementName"] = name
+    return pywbem.CIMInstance("CIM_FCPort", properties=properties)
+
+
+class DiscoverPortsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (emc_vnx_ecom.state_dir, emc_vnx_ecom.fast_parse)
+        emc_vnx_ecom.state_dir = tempfile.mkdtemp()
+        emc_vnx_ecom.fast_parse = False
+
+    def tearDown(self):
+        shutil.rmtree(emc_vnx_ecom.state_dir)
+        emc_vnx_ecom.state_dir, emc_vnx_ecom.fast_parse = self.saved
+
+    def connection(self, ports):
+        conn = emc_vnx_ecom.ECOMConnection.__new__(
+            emc_vnx_ecom.ECOMConnection)
+        conn.conn = FakeWBEMConnection(ports)
+        conn.ecom_ip = "ecom"
+        conn.retried = False
+        conn.requests = 0
+        conn.failed = []
+        return conn
+
+    def test_front_end_ports(self):
+        conn = self.connection({"CIM_FCPort": [
+            port("FC0", "CLAR+%s+SP_A+FC+0" % serial, number=0),
+            port("FC1", "CLAR+%s+SP_A+FC+1" % serial, name="Port One"),
+            port("BE0")]})
+
+        ports = emc_vnx_discovery.discover_array_ports(conn, serial)
+
+        self.assertEqual([(i.device_id, i.name, i.sp, i.port_type)
+                          for i in ports],
+                         [("FC0", "SPA FC Port 0", "SPA", "FC"),
+                          ("FC1", "Port One", "SPA", "FC")])
+
+
+if __name__ == "__main__":
+    unittest.main()
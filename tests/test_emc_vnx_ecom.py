@@ -0,0 +1,91 @@
+#!/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import pywbem
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import emc_vnx_ecom
+
+
+def volume(device_id, owner=None):
+    """ Returns a CIMInstance like the ECOM's Clar_StorageVolume """
+
+    properties = {"DeviceID": device_id,
+                  "BlockSize": pywbem.Uint64(512)}
+    if owner is not None:
+        properties["EMCCurrentOwningStorageProcessor"] = owner
+    return pywbem.CIMInstance("Clar_StorageVolume", properties=properties)
+
+
+class FakeWBEMConnection(object):
+    """ Answers Associators with real CIMInstances """
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def Associators(self, ObjectName, **kwargs):
+        return self.instances
+
+
+class AssociatorPropertiesTest(unittest.TestCase):
+
+    properties = ["DeviceID", "BlockSize", "EMCCurrentOwningStorageProcessor"]
+
+    def setUp(self):
+        self.saved = (emc_vnx_ecom.state_dir, emc_vnx_ecom.fast_parse,
+                      emc_vnx_ecom.fast_parse_supported,
+                      emc_vnx_ecom.associators_request,
+                      emc_vnx_ecom.wbem_post)
+        emc_vnx_ecom.state_dir = tempfile.mkdtemp()
+
+        self.conn = emc_vnx_ecom.ECOMConnection.__new__(
+            emc_vnx_ecom.ECOMConnection)
+        self.conn.conn = FakeWBEMConnection([volume("00001", "SP_A"),
+                                             volume("00002")])
+        self.conn.ecom_ip = "ecom"
+        self.conn.retried = False
+        self.conn.requests = 0
+        self.conn.failed = []
+
+    def tearDown(self):
+        shutil.rmtree(emc_vnx_ecom.state_dir)
+        (emc_vnx_ecom.state_dir, emc_vnx_ecom.fast_parse,
+         emc_vnx_ecom.fast_parse_supported, emc_vnx_ecom.associators_request,
+         emc_vnx_ecom.wbem_post) = self.saved
+
+    def check_records(self, records):
+        self.assertEqual(records, [
+            {"DeviceID": "00001", "BlockSize": 512,
+             "EMCCurrentOwningStorageProcessor": "SP_A"},
+            {"DeviceID": "00002", "BlockSize": 512,
+             "EMCCurrentOwningStorageProcessor": None}])
+        for record in records:
+            self.assertTrue(isinstance(record, dict))
+
+    def test_without_fast_parse(self):
+        emc_vnx_ecom.fast_parse = False
+        self.check_records(self.conn.AssociatorProperties(
+            None, self.properties, ResultClass="CIM_StorageVolume"))
+
+    def test_fast_parse_failure(self):
+        emc_vnx_ecom.fast_parse = True
+        emc_vnx_ecom.fast_parse_supported = lambda conn: True
+        emc_vnx_ecom.associators_request = lambda *args: ""
+        emc_vnx_ecom.wbem_post = lambda conn, method, data: "<CIM><broken"
+        self.check_records(self.conn.AssociatorProperties(
+            None, self.properties, ResultClass="CIM_StorageVolume"))
+
+    def test_instance_properties(self):
+        self.assertEqual(
+            emc_vnx_ecom.instance_properties(volume("00003"),
+                                             ["DeviceID", "ElementName"]),
+            {"DeviceID": "00003", "ElementName": None})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import pywbem
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import emc_vnx_stats
+from emc_vnx_records import VolumeRecord
+
+
+def device(classname, operational_status=None, descriptions=None):
+    """ Returns a CIMInstance like the ECOM's health classes """
+
+    properties = {"DeviceID": "%s_0" % classname}
+    if operational_status is not None:
+        properties["OperationalStatus"] = [pywbem.Uint16(i)
+                                           for i in operational_status]
+    if descriptions is not None:
+        properties["StatusDescriptions"] = descriptions
+    return pywbem.CIMInstance(classname, properties=properties)
+
+
+class DeviceRecordTest(unittest.TestCase):
+
+    def test_operational_status(self):
+        record = emc_vnx_stats.device_record(
+            "fan", device("EMC_PowerDevice", [2, 3], ["OK", "Degraded"]))
+        self.assertEqual(record.status, emc_vnx_stats.STATUS_WARNING)
+        self.assertEqual(record.detail, "OK Degraded")
+
+    def test_emc_status_from_description(self):
+        record = emc_vnx_stats.device_record(
+            "disk", device("EMC_DiskDrive", [32769], ["Rebuilding"]))
+        self.assertEqual(record.status, emc_vnx_stats.STATUS_WARNING)
+
+    def test_missing_operational_status(self):
+        record = emc_vnx_stats.device_record(
+            "lcc", device("EMC_LinkControlDevice", None, ["Faulted"]))
+        self.assertEqual(record.status, emc_vnx_stats.STATUS_CRITICAL)
+
+    def test_no_status_at_all(self):
+        record = emc_vnx_stats.device_record("sps",
+                                             device("EMC_BatteryDevice"))
+        self.assertEqual(record.status, emc_vnx_stats.STATUS_UNKNOWN)
+        self.assertEqual(record.detail, "")
+
+
+class SummaryStatsTest(unittest.TestCase):
+
+    header_row = ["InstanceID", "TotalIOs", "EMCSPAReadIOs", "EMCSPBReadIOs"]
+
+    def setUp(self):
+        self.saved = emc_vnx_stats.state_dir
+        emc_vnx_stats.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(emc_vnx_stats.state_dir)
+        emc_vnx_stats.state_dir = self.saved
+
+    def summary(self, rows, timestamp, element_info):
+        sample = emc_vnx_stats.CounterSample(
+            self.header_row, rows, "APM0001_Volumes_counters", timestamp,
+            emc_vnx_stats.summary_counters)
+        results, top_ids, dev_ids = emc_vnx_stats.summary_stats(
+            self.header_row, sample, "APM0001", "Volumes", timestamp, 1,
+            element_info)
+        return dict(results)
+
+    def test_scoped_by_owner(self):
+        # LUN_1 is owned by SPB but all of its IO went through SPA
+        volume_info = {"LUN_1": VolumeRecord("LUN_1", owner="SPB"),
+                       "LUN_2": VolumeRecord("LUN_2", owner="SPA")}
+        self.summary([["LUN_1", "0", "0", "0"], ["LUN_2", "0", "0", "0"]],
+                     "1000", volume_info)
+        results = self.summary([["LUN_1", "600", "600", "0"],
+                                ["LUN_2", "60", "0", "60"]],
+                               "1060", volume_info)
+
+        key = "emc.vnx.summary.IOPS[Volumes,%s,max]"
+        self.assertEqual(results[key % "Array"], 10.0)
+        self.assertEqual(results[key % "SPB"], 10.0)
+        self.assertEqual(results[key % "SPA"], 1.0)
+
+    def test_no_owner(self):
+        self.summary([["0_0_1", "0", "0", "0"]], "1000", None)
+        results = self.summary([["0_0_1", "60", "60", "0"]], "1060", None)
+
+        self.assertEqual(results["emc.vnx.summary.IOPS[Volumes,Array,max]"],
+                         1.0)
+        self.assertNotIn("emc.vnx.summary.IOPS[Volumes,SPA,max]", results)
+
+
+class GroupStatsTest(unittest.TestCase):
+
+    header_row = ["InstanceID", "TotalIOs", "KBytesTransferred"]
+
+    def setUp(self):
+        self.saved = emc_vnx_stats.state_dir
+        emc_vnx_stats.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(emc_vnx_stats.state_dir)
+        emc_vnx_stats.state_dir = self.saved
+
+    def groups(self, rows, timestamp):
+        volume_info = {"LUN_1": VolumeRecord("LUN_1", pool_id="Pool_0"),
+                       "LUN_2": VolumeRecord("LUN_2", pool_id="Pool_0"),
+                       "LUN_3": VolumeRecord("LUN_3", pool_id="Pool_1")}
+        sample = emc_vnx_stats.CounterSample(
+            self.header_row, rows, "APM0001_Volumes_counters", timestamp,
+            emc_vnx_stats.group_counters)
+        return dict(emc_vnx_stats.group_stats(
+            self.header_row, sample, "APM0001", timestamp, volume_info,
+            [("pool_id", "PoolVol")]))
+
+    def test_totals_and_rates(self):
+        self.groups([["LUN_1", "600", "10"], ["LUN_2", "6000", "20"],
+                     ["LUN_3", "60", "30"]], "1000")
+        # LUN_2 was reset, it is left out of the rate until the next sample
+        results = self.groups([["LUN_1", "1200", "70"], ["LUN_2", "60", "20"],
+                               ["LUN_3", "120", "18446744073709551615"]],
+                              "1060")
+
+        self.assertEqual(results["emc.vnx.perf.PoolVolTotalIOs[Pool_0]"], 1260)
+        self.assertEqual(results["emc.vnx.perf.PoolVolIOPS[Pool_0]"], 10.0)
+        self.assertEqual(results["emc.vnx.perf.PoolVolKBps[Pool_0]"], 1.0)
+        self.assertEqual(results["emc.vnx.perf.PoolVolIOPS[Pool_1]"], 1.0)
+        self.assertNotIn("emc.vnx.perf.PoolVolKBps[Pool_1]", results)
+
+
+class SPBalanceStatsTest(unittest.TestCase):
+
+    header_row = ["InstanceID"] + emc_vnx_stats.balance_counters
+
+    def setUp(self):
+        self.saved = emc_vnx_stats.state_dir
+        emc_vnx_stats.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(emc_vnx_stats.state_dir)
+        emc_vnx_stats.state_dir = self.saved
+
+    def balance(self, rows, timestamp):
+        volume_info = {"LUN_1": VolumeRecord("LUN_1", owner="SPA"),
+                       "LUN_2": VolumeRecord("LUN_2", owner="SPB")}
+        sample = emc_vnx_stats.CounterSample(
+            self.header_row, rows, "APM0001_Volumes_counters", timestamp,
+            emc_vnx_stats.balance_counters)
+        return dict(emc_vnx_stats.sp_balance_stats(
+            self.header_row, sample, "APM0001", timestamp, volume_info))
+
+    def test_non_owner_share(self):
+        self.assertEqual(self.balance([["LUN_1"] + ["0"] * 10,
+                                       ["LUN_2"] + ["0"] * 10], "1000"), {})
+        # LUN_1 did 30 of its 100 IOs through SPB, LUN_2 all through SPB
+        results = self.balance(
+            [["LUN_1", "40", "30", "20", "10"] + ["0"] * 4 + ["1", "0"],
+             ["LUN_2", "0", "0", "50", "50"] + ["0"] * 6], "1060")
+
+        self.assertEqual(results["emc.vnx.perf.VolNonOwnerIORatio[LUN_1]"],
+                         30.0)
+        self.assertEqual(results["emc.vnx.perf.VolNonOwnerIORatio[LUN_2]"],
+                         0.0)
+        self.assertEqual(results["emc.vnx.perf.SPVolIOShare[SPA]"], 35.0)
+        self.assertEqual(results["emc.vnx.perf.NonOwnerVolumes[Array]"], 1)
+        self.assertEqual(
+            results["emc.vnx.perf.VolImplicitTrespasses[Array]"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,52 +1,287 @@
 #!/bin/env python
 
+import os
 import sys
 import json
+import time
+import Queue
 import pywbem
 import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import emc_vnx_ecom
+
+# Results of EMCAddSystem
+add_system_results = {0: "Success", 1: "Not Supported", 2: "Unknown",
+                      3: "Timeout", 4: "Failed", 5: "Invalid Parameter",
+                      6: "In Use", 7: "Existing"}
+
+# Bulk registration defaults
+workers = 4             # arrays registered at once
+poll_interval = 30      # in seconds, between readiness checks
+ready_timeout = 1800    # in seconds, to wait for an array to be ready
+
+
+def ecom_connect(ecom_ip, ecom_user="admin", ecom_pass="#1Password"):
+    """ returns a connection to the ecom server, ecom_ip takes the same
+        endpoints as the collection scripts, https on port 5989 by default
+        or e.g. "http://127.0.0.1:15988" for tools/ecom_vnx_standin.py """
+    return emc_vnx_ecom.ecom_connect(ecom_ip, ecom_user, ecom_pass)
+
+
+def result_text(code):
+    return add_system_results.get(code, "Unknown result %s" % code)
+
+
+def register_vnx(ecom_conn, spa_ip, spb_ip, array_user, array_pass):
+    """ Adds the array to the ECOM, returns the EMCAddSystem result code and
+        the serial of the array if the ECOM reported it """
+
+    ers = ecom_conn.EnumerateInstanceNames("EMC_SystemRegistrationService")
+    o = ecom_conn.InvokeMethod("EMCAddSystem", ers[0],
+                               ArrayType=pywbem.Uint16(1),
+                               Addresses=[spa_ip, spb_ip],
+                               Types=[pywbem.Uint16(2), pywbem.Uint16(2)],
+                               User=array_user, Password=array_pass)
+
+    serial = None
+    system = o[1].get("System") if o[1] else None
+    if system is not None and "Name" in system.keybindings:
+        serial = system["Name"].split("+")[-1]
+
+    return (int(o[0]), serial, o)
 
 
 def add_vnx(spa_ip, spb_ip, array_user, array_pass,
             ecom_ip, ecom_user="admin", ecom_pass="#1Password"):
 
-    ecom_url = "https://%s:5989" % ecom_ip
-    ecom_conn = pywbem.WBEMConnection(ecom_url,(ecom_user,ecom_pass),
-                                      default_namespace="/root/emc")
-    ers = ecom_conn.EnumerateInstanceNames("EMC_SystemRegistrationService")
-    o = ecom_conn.InvokeMethod("EMCAddSystem",ers[0],
-                               ArrayType = pywbem.Uint16(1),
-                               Addresses = [spa_ip,spb_ip],
-                               Types = [pywbem.Uint16(2),pywbem.Uint16(2)],
-                               User = array_user, Password = array_pass 
-                             )
-  
-    results  = ["Success","Not Supported","Unknown","Timeout","Failed",
-                "Inavlid Parameter","In Use","Existing"]
+    ecom_conn = ecom_connect(ecom_ip, ecom_user, ecom_pass)
+    result, serial, o = register_vnx(ecom_conn, spa_ip, spb_ip,
+                                     array_user, array_pass)
+
     print "Execution Ouput:"
     print o
-    print "Result: %s" % results[o[0]]
+    print "Result: %s" % result_text(result)
+
+
+def find_array(ecom_conn, serial):
+    """ Returns the Clar_StorageSystem of the serial, None if not there yet """
+
+    for array in ecom_conn.EnumerateInstanceNames("Clar_StorageSystem"):
+        if array["Name"] == "CLARiiON+%s" % serial:
+            return array
+
+    return None
+
+
+def stats_ready(ecom_conn, array):
+    """ True once the statistics service of the array returns data """
+
+    services = ecom_conn.AssociatorNames(
+        array, ResultClass="CIM_BlockStatisticsService")
+    if not services:
+        return False
+
+    o = ecom_conn.InvokeMethod("GetStatisticsCollection", services[0],
+                               StatisticsFormat=pywbem.Uint16(2))
+    statistics = o[1].get("Statistics") if o[1] else None
+
+    return bool(statistics) and any([i.strip() for i in statistics])
+
+
+def read_inventory(inventory_file):
+    """ Reads "spa_ip spb_ip array_user array_pass [serial]" lines, blank
+        lines and # comments are skipped """
+
+    arrays = []
+    with open(inventory_file) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (4, 5):
+                raise ValueError("%s line %d: expected spa_ip spb_ip "
+                                 "array_user array_pass [serial]" % (
+                                     inventory_file, number))
+            arrays.append({"spa_ip": fields[0], "spb_ip": fields[1],
+                           "user": fields[2], "password": fields[3],
+                           "serial": fields[4] if len(fields) == 5 else None})
+
+    return arrays
+
+
+def onboard_array(array, ecom_ip, ecom_user, ecom_pass):
+    """ Registers one array then waits for it to be ready, returns the
+        report entry for it """
+
+    started = time.time()
+    report = {"spa_ip": array["spa_ip"], "serial": array["serial"],
+              "result": None, "status": "FAILED", "registered": None,
+              "visible": None, "stats": None, "error": None}
+
+    try:
+        ecom_conn = ecom_connect(ecom_ip, ecom_user, ecom_pass)
+
+        result, serial, o = register_vnx(ecom_conn, array["spa_ip"],
+                                         array["spb_ip"], array["user"],
+                                         array["password"])
+        report["result"] = result_text(result)
+        report["registered"] = time.time() - started
+        report["serial"] = report["serial"] or serial
+
+        if result not in (0, 7):    # Success or already Existing
+            return report
+
+        if not report["serial"]:
+            report["status"] = "UNKNOWN"
+            report["error"] = "No serial in the inventory or the result"
+            return report
+
+        array_name = None
+        while time.time() - started < ready_timeout:
+            if array_name is None:
+                array_name = find_array(ecom_conn, report["serial"])
+                if array_name is not None:
+                    report["visible"] = time.time() - started
+
+            try:
+                if array_name is not None and \
+                        stats_ready(ecom_conn, array_name):
+                    report["stats"] = time.time() - started
+                    report["status"] = "READY"
+                    report["error"] = None
+                    return report
+            except pywbem.CIMError, e:
+                # e.g. the statistics service is not enabled yet
+                report["error"] = str(e)
+
+            time.sleep(poll_interval)
+
+        report["status"] = "TIMEOUT"
+    except emc_vnx_ecom.wbem_errors + (IOError,
+                                       emc_vnx_ecom.ECOMUnavailable), e:
+        report["error"] = str(e)
+    except Exception, e:
+        # Anything else still ends up in the report, rather than taking
+        # the worker down with it
+        report["error"] = "%s: %s" % (e.__class__.__name__, str(e))
+
+    return report
+
+
+def bulk_add(arrays, ecom_ip, ecom_user, ecom_pass, worker_count):
+    """ Onboards the arrays with worker_count of them in flight at once,
+        returns the report entries in inventory order """
+
+    pending = Queue.Queue()
+    for index, array in enumerate(arrays):
+        pending.put((index, array))
+
+    reports = [None] * len(arrays)
+    print_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                index, array = pending.get_nowait()
+            except Queue.Empty:
+                return
+            reports[index] = onboard_array(array, ecom_ip, ecom_user,
+                                           ecom_pass)
+            with print_lock:
+                print "%s: %s" % (array["spa_ip"], reports[index]["status"])
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(worker_count, len(arrays)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    return reports
+
+
+def print_report(reports):
+    """ Prints the summary table of a bulk registration """
+
+    def seconds(value):
+        return "-" if value is None else "%d" % value
+
+    print ""
+    print "%-16s %-16s %-18s %-8s %6s %6s %6s" % (
+        "SPA", "Serial", "Result", "Status", "Reg s", "Vis s", "Stat s")
+    for report in reports:
+        print "%-16s %-16s %-18s %-8s %6s %6s %6s" % (
+            report["spa_ip"], report["serial"] or "-",
+            report["result"] or "-", report["status"],
+            seconds(report["registered"]), seconds(report["visible"]),
+            seconds(report["stats"]))
+        if report["error"]:
+            print "    %s" % report["error"]
+
+    ready = len([i for i in reports if i["status"] == "READY"])
+    print ""
+    print "%d of %d arrays ready" % (ready, len(reports))
+
 
 def main():
-   
+
+    global poll_interval, ready_timeout
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("spa_ip", help="IP Address of SPA")
-    parser.add_argument("spb_ip", help="IP Address of SPB")
-    parser.add_argument("array_user", help="Username for Array")
-    parser.add_argument("array_pass", help="Password for Array")
-    parser.add_argument("ecom_ip", help="IP Address of ECOM Server")
+    parser.add_argument("spa_ip", nargs="?", help="IP Address of SPA")
+    parser.add_argument("spb_ip", nargs="?", help="IP Address of SPB")
+    parser.add_argument("array_user", nargs="?", help="Username for Array")
+    parser.add_argument("array_pass", nargs="?", help="Password for Array")
+    parser.add_argument("ecom_ip", nargs="?", help="IP Address of ECOM Server")
     parser.add_argument("--ecom_user", help="Username for ECOM Server",
                         default="admin")
     parser.add_argument("--ecom_pass", help="Password for ECOM Server",
                         default="#1Password")
-
+    parser.add_argument("--inventory", "-f",
+                        help="Register every array of this file, one "
+                             "\"spa_ip spb_ip array_user array_pass [serial]\""
+                             " per line, the ECOM is given with --ecom_ip")
+    parser.add_argument("--ecom_ip", dest="bulk_ecom_ip",
+                        help="IP Address of ECOM Server, for --inventory")
+    parser.add_argument("--workers", type=int, default=workers,
+                        help="Arrays registered at once")
+    parser.add_argument("--poll_interval", type=float, default=poll_interval,
+                        help="Seconds between readiness checks")
+    parser.add_argument("--ready_timeout", type=float, default=ready_timeout,
+                        help="Seconds to wait for each array to be ready")
+    parser.add_argument("--json", help="Also write the report to this file")
 
     args = parser.parse_args()
 
+    if args.inventory:
+        if not args.bulk_ecom_ip:
+            parser.error("--inventory needs --ecom_ip")
+
+        poll_interval = args.poll_interval
+        ready_timeout = args.ready_timeout
+
+        reports = bulk_add(read_inventory(args.inventory), args.bulk_ecom_ip,
+                           args.ecom_user, args.ecom_pass, args.workers)
+        print_report(reports)
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(reports, f, indent=4)
+
+        if [i for i in reports if i["status"] != "READY"]:
+            sys.exit(1)
+        return
+
+    if not args.ecom_ip:
+        parser.error("spa_ip spb_ip array_user array_pass ecom_ip are "
+                     "required without --inventory")
+
     add_vnx(args.spa_ip, args.spb_ip, args.array_user, args.array_pass,
             args.ecom_ip, args.ecom_user, args.ecom_pass)
 
 if __name__ == "__main__":
     main()
-
-   
-
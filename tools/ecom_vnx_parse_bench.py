@@ -0,0 +1,174 @@
+#!/bin/env python
+
+import os
+import sys
+import time
+import random
+import argparse
+
+# pywbem and emc_vnx_ecom (which needs pywbem) are only imported by the
+# subcommands using them, generate runs without either
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Properties read by the volume collection, see get_volume_info()
+volume_properties = ["EMCBSPInstanceID", "DeviceID", "ElementName",
+                     "EMCCurrentOwningStorageProcessor", "BlockSize",
+                     "NumberOfBlocks"]
+
+# Padding properties of a generated volume, the real ones carry ~60
+filler_properties = ["Caption", "Description", "ElementType", "Purpose",
+                     "SystemName", "SystemCreationClassName", "Status",
+                     "EMCWWN", "EMCRaidLevel", "EMCPoolID", "NameFormat"]
+
+
+def record(args):
+    """ Saves the raw response of an Associators call to a live ECOM """
+
+    import pywbem
+    import emc_vnx_ecom
+
+    ecom_url = "https://%s:5989" % args.ecom_ip
+    conn = pywbem.WBEMConnection(ecom_url, (args.ecom_user, args.ecom_pass),
+                                 default_namespace="/root/emc")
+
+    array = None
+    for i in conn.EnumerateInstanceNames("Clar_StorageSystem"):
+        if args.serial in i["Name"]:
+            array = i
+    if array is None:
+        sys.exit("Array %s is not registered on the ECOM" % args.serial)
+
+    # No PropertyList, the recording has to serve any property set
+    request = emc_vnx_ecom.associators_request(conn, array, None,
+                                               result_class=args.cls)
+    response = emc_vnx_ecom.wbem_post(conn, "Associators", request)
+
+    with open(args.output, "w") as f:
+        f.write(response)
+
+    print "Saved %d bytes to %s" % (len(response), args.output)
+
+
+def cim_property(name, cim_type, value):
+    return ('<PROPERTY NAME="%s" TYPE="%s"><VALUE>%s</VALUE></PROPERTY>' %
+            (name, cim_type, value))
+
+
+def generate(args):
+    """ Writes an Associators response shaped like a CIM_StorageVolume
+        enumeration of a large array """
+
+    serial = "APM00000000001"
+    with open(args.output, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8" ?>'
+                '<CIM CIMVERSION="2.0" DTDVERSION="2.0">'
+                '<MESSAGE ID="1001" PROTOCOLVERSION="1.0"><SIMPLERSP>'
+                '<IMETHODRESPONSE NAME="Associators"><IRETURNVALUE>')
+        for i in range(args.count):
+            device_id = "%05X" % i
+            f.write('<VALUE.OBJECTWITHPATH><INSTANCEPATH>'
+                    '<NAMESPACEPATH><HOST>ecom</HOST><LOCALNAMESPACEPATH>'
+                    '<NAMESPACE NAME="root"/><NAMESPACE NAME="emc"/>'
+                    '</LOCALNAMESPACEPATH></NAMESPACEPATH>'
+                    '<INSTANCENAME CLASSNAME="Clar_StorageVolume">'
+                    '<KEYBINDING NAME="DeviceID"><KEYVALUE VALUETYPE="string">'
+                    '%s</KEYVALUE></KEYBINDING></INSTANCENAME></INSTANCEPATH>'
+                    '<INSTANCE CLASSNAME="Clar_StorageVolume">' % device_id)
+            f.write(cim_property("EMCBSPInstanceID", "string",
+                                 "CLAR+%s+%d" % (serial, i)))
+            f.write(cim_property("DeviceID", "string", device_id))
+            f.write(cim_property("ElementName", "string", "LUN %d" % i))
+            f.write(cim_property("EMCCurrentOwningStorageProcessor", "string",
+                                 random.choice(["SP_A", "SP_B"])))
+            f.write(cim_property("BlockSize", "uint64", 512))
+            f.write(cim_property("NumberOfBlocks", "uint64",
+                                 random.randint(2 ** 20, 2 ** 32)))
+            for name in filler_properties:
+                f.write(cim_property(name, "string", "%s of %s" %
+                                     (name, device_id)))
+            f.write('<PROPERTY.ARRAY NAME="OperationalStatus" TYPE="uint16">'
+                    '<VALUE.ARRAY><VALUE>2</VALUE></VALUE.ARRAY>'
+                    '</PROPERTY.ARRAY>')
+            f.write('</INSTANCE></VALUE.OBJECTWITHPATH>')
+        f.write('</IRETURNVALUE></IMETHODRESPONSE></SIMPLERSP></MESSAGE>'
+                '</CIM>')
+
+    print "Wrote %d instances to %s" % (args.count, args.output)
+
+
+def standard_parse(response, properties):
+    """ What WBEMConnection.Associators does with a response, followed by
+        reading the properties the way the collectors do """
+
+    from pywbem import tupletree, tupleparse
+
+    tt = tupleparse.parse_cim(tupletree.xml_to_tupletree(response))
+    return_value = tt[2][2][0][2][2]
+    instances = [i[2] for i in return_value[2]]
+    # CIMInstance has no get() before pywbem 0.8
+    return [dict([(p, i[p] if p in i.properties else None)
+                  for p in properties]) for i in instances]
+
+
+def fast_parse(response, properties):
+    import emc_vnx_ecom
+    return list(emc_vnx_ecom.parse_instances(response, properties))
+
+
+def bench(args):
+    properties = args.properties.split(",")
+
+    for response_file in args.responses:
+        with open(response_file) as f:
+            response = f.read()
+
+        results = dict()
+        for name, parser in (("standard", standard_parse),
+                             ("fast", fast_parse)):
+            best = None
+            for i in range(args.repeat):
+                start = time.time()
+                results[name] = parser(response, properties)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print "%s: %-8s %6d instances %8.3fs" % (
+                os.path.basename(response_file), name,
+                len(results[name]), best)
+
+        if results["standard"] != results["fast"]:
+            sys.exit("%s: the parsers disagree" % response_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the standard pywbem parsing of Associators "
+                    "responses with the streaming parser of emc_vnx_ecom")
+    sub = parser.add_subparsers()
+
+    rec = sub.add_parser("record", help="Save a response from an ECOM")
+    rec.add_argument('--ecom_ip', required=True)
+    rec.add_argument('--ecom_user', default="admin")
+    rec.add_argument('--ecom_pass', default="#1Password")
+    rec.add_argument('--serial', required=True)
+    rec.add_argument('--cls', default="CIM_StorageVolume",
+                     help="ResultClass to enumerate")
+    rec.add_argument('output')
+    rec.set_defaults(func=record)
+
+    gen = sub.add_parser("generate", help="Write a synthetic response")
+    gen.add_argument('--count', type=int, default=10000)
+    gen.add_argument('output')
+    gen.set_defaults(func=generate)
+
+    run = sub.add_parser("run", help="Time both parsers on responses")
+    run.add_argument('--properties', default=",".join(volume_properties),
+                     help="Comma separated properties to extract")
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('responses', nargs="+")
+    run.set_defaults(func=bench)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/bin/env python
+
+""" Runs several local stand-in ECOM endpoints, to try out failover and load
+    spreading of emc_vnx_ecom without real ECOM servers
+
+    Each endpoint answers CIM-XML over plain HTTP on consecutive ports.  The
+    array given with --serial is enumerated as a Clar_StorageSystem, other
+    operations get the recorded response in --responses named after the
+    operation and class (Associators_CIM_StorageVolume.xml, see
+    ecom_vnx_parse_bench.py record) or an empty result.
+
+    Arrays can also be registered with EMCAddSystem, as ecom_vnx_manage.py
+    does, their serial is made up from the SPA address.  They are
+    enumerated right away, their statistics service returns a placeholder
+    sample once --ready_delay has passed.  Registering an SPA given with
+    --fail_ip fails.
+
+    Point the scripts at them with, for example:
+
+        --ecom_ip "http://127.0.0.1:15988 http://127.0.0.1:15989"
+
+    or try a bulk registration with:
+
+        ecom_vnx_manage.py --inventory arrays.txt --poll_interval 1
+            --ecom_ip "http://127.0.0.1:15988 http://127.0.0.1:15989"
+
+    GET /fail on an endpoint makes it answer every request with a HTTP 500,
+    /hang makes it stop answering, /recover undoes both.  On Ctrl-C or SIGTERM
+    it prints how many requests each endpoint served. """
+
+import os
+import sys
+import time
+import socket
+import struct
+import signal
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import xml.etree.cElementTree as ElementTree
+
+# Stand-in defaults
+endpoint_count = 3
+base_port = 15988
+serial = "APM00000000001"
+
+response_header = ('<?xml version="1.0" encoding="utf-8" ?>'
+                   '<CIM CIMVERSION="2.0" DTDVERSION="2.0">'
+                   '<MESSAGE ID="1001" PROTOCOLVERSION="1.0"><SIMPLERSP>'
+                   '<IMETHODRESPONSE NAME="%s"><IRETURNVALUE>')
+response_footer = ('</IRETURNVALUE></IMETHODRESPONSE></SIMPLERSP></MESSAGE>'
+                   '</CIM>')
+method_header = ('<?xml version="1.0" encoding="utf-8" ?>'
+                 '<CIM CIMVERSION="2.0" DTDVERSION="2.0">'
+                 '<MESSAGE ID="1001" PROTOCOLVERSION="1.0"><SIMPLERSP>'
+                 '<METHODRESPONSE NAME="%s">')
+method_footer = '</METHODRESPONSE></SIMPLERSP></MESSAGE></CIM>'
+
+# EMCAddSystem results, see ecom_vnx_manage.py
+ADD_SUCCESS = 0
+ADD_FAILED = 4
+ADD_EXISTING = 7
+
+
+def instance_name(cls, keys):
+    """ Returns an INSTANCENAME of cls with the (name, value) string keys """
+
+    return ('<INSTANCENAME CLASSNAME="%s">' % cls + "".join([
+        '<KEYBINDING NAME="%s"><KEYVALUE VALUETYPE="string">%s</KEYVALUE>'
+        '</KEYBINDING>' % (name, value) for name, value in keys]) +
+        '</INSTANCENAME>')
+
+
+def array_names(serial):
+    return instance_name("Clar_StorageSystem",
+                         [("CreationClassName", "Clar_StorageSystem"),
+                          ("Name", "CLARiiON+%s" % serial)])
+
+
+def registration_service():
+    return instance_name("EMC_SystemRegistrationService",
+                         [("CreationClassName",
+                           "EMC_SystemRegistrationService"),
+                          ("Name", "EMCSystemRegistrationService"),
+                          ("SystemCreationClassName", "EMC_ECOMSystem"),
+                          ("SystemName", "StandIn")])
+
+
+def statistics_service(serial):
+    return instance_name("Clar_BlockStatisticsService",
+                         [("CreationClassName",
+                           "Clar_BlockStatisticsService"),
+                          ("Name", "EMCBlockStatisticsService"),
+                          ("SystemCreationClassName", "Clar_StorageSystem"),
+                          ("SystemName", "CLARiiON+%s" % serial)])
+
+
+def object_path(name):
+    return ('<OBJECTPATH><INSTANCEPATH><NAMESPACEPATH><HOST>localhost</HOST>'
+            '<LOCALNAMESPACEPATH><NAMESPACE NAME="root"/>'
+            '<NAMESPACE NAME="emc"/></LOCALNAMESPACEPATH></NAMESPACEPATH>'
+            '%s</INSTANCEPATH></OBJECTPATH>' % name)
+
+
+def serial_of(spa_ip):
+    """ Makes up the serial of an array registered through spa_ip """
+
+    try:
+        number = struct.unpack("!I", socket.inet_aton(spa_ip))[0]
+    except socket.error:
+        number = abs(hash(spa_ip))
+    return "APM%011d" % (number % 10 ** 11)
+
+
+def key_value(element, key):
+    """ Returns the value of a key in the first INSTANCENAME of element """
+
+    for binding in element.iter("KEYBINDING"):
+        if binding.get("NAME") == key:
+            return binding.findtext("KEYVALUE")
+    return None
+
+
+def request_class(request):
+    """ Returns the operation, the class a CIM-XML request is about and its
+        parameters, as elements by name """
+
+    root = ElementTree.fromstring(request)
+    call = root.find(".//IMETHODCALL")
+    params = dict()
+    if call is not None:
+        cls = None
+        for param in call.findall("IPARAMVALUE"):
+            params[param.get("NAME")] = param
+            if param.get("NAME") in ("ClassName", "ResultClass"):
+                cls = param.find("CLASSNAME").get("NAME")
+        return call.get("NAME"), cls, params
+
+    # Extrinsic methods, invoked on an instance
+    call = root.find(".//METHODCALL")
+    if call is None:
+        return None, None, params
+
+    name = call.find(".//INSTANCENAME")
+    for param in call.findall("PARAMVALUE"):
+        params[param.get("NAME")] = param
+    params["ObjectName"] = call
+
+    return call.get("NAME"), name.get("CLASSNAME") if name is not None \
+        else None, params
+
+
+class Registry(object):
+    """ Arrays known to the endpoints, shared by all of them """
+
+    def __init__(self, serial, ready_delay, fail_ips):
+        self.lock = threading.Lock()
+        self.ready_delay = ready_delay
+        self.fail_ips = fail_ips
+        self.registered = {serial: 0}
+
+    def serials(self):
+        with self.lock:
+            return sorted(self.registered.keys())
+
+    def add(self, spa_ip):
+        """ Returns the EMCAddSystem result and serial of a registration """
+
+        if spa_ip in self.fail_ips:
+            return ADD_FAILED, None
+
+        serial = serial_of(spa_ip)
+        with self.lock:
+            if serial in self.registered:
+                return ADD_EXISTING, serial
+            self.registered[serial] = time.time()
+        return ADD_SUCCESS, serial
+
+    def ready(self, serial):
+        with self.lock:
+            added = self.registered.get(serial)
+        return added is not None and \
+            time.time() - added >= self.ready_delay
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path in ("/fail", "/hang", "/recover"):
+            self.server.state = self.path[1:]
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write("%s\n" % self.server.state)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers["Content-Length"]))
+
+        while self.server.state == "hang":
+            time.sleep(1)
+        if self.server.state == "fail":
+            self.send_error(500)
+            return
+
+        with self.server.lock:
+            self.server.served += 1
+
+        registry = self.server.registry
+        method, cls, params = request_class(request)
+        body = ""
+        if method == "EnumerateInstanceNames" and \
+                cls == "Clar_StorageSystem":
+            body = "".join([array_names(i) for i in registry.serials()])
+        elif method == "EnumerateInstanceNames" and \
+                cls == "EMC_SystemRegistrationService":
+            body = registration_service()
+        elif method == "AssociatorNames" and \
+                cls == "CIM_BlockStatisticsService":
+            serial = key_value(params["ObjectName"], "Name").split("+")[-1]
+            if serial in registry.serials():
+                body = object_path(statistics_service(serial))
+        elif method == "EMCAddSystem":
+            addresses = [i.text for i in params["Addresses"].iter("VALUE")]
+            result, serial = registry.add(addresses[0])
+            body = ('<RETURNVALUE PARAMTYPE="uint32"><VALUE>%d</VALUE>'
+                    '</RETURNVALUE>' % result)
+            if serial:
+                body += ('<PARAMVALUE NAME="System" PARAMTYPE="reference">'
+                         '<VALUE.REFERENCE>%s</VALUE.REFERENCE>'
+                         '</PARAMVALUE>' % array_names(serial))
+            self.send_body(method_header % method + body + method_footer)
+            return
+        elif method == "GetStatisticsCollection":
+            serial = key_value(params["ObjectName"],
+                               "SystemName").split("+")[-1]
+            statistics = [""] * 6
+            if registry.ready(serial):
+                statistics[0] = "CLARiiON+%s;%s" % (serial, time.strftime(
+                    "%Y%m%d%H%M%S.000000+000"))
+            body = ('<RETURNVALUE PARAMTYPE="uint32"><VALUE>0</VALUE>'
+                    '</RETURNVALUE><PARAMVALUE NAME="Statistics" '
+                    'PARAMTYPE="string"><VALUE.ARRAY>%s</VALUE.ARRAY>'
+                    '</PARAMVALUE>' % "".join(["<VALUE>%s</VALUE>" % i
+                                                for i in statistics]))
+            self.send_body(method_header % method + body + method_footer)
+            return
+        elif self.server.responses:
+            recorded = os.path.join(self.server.responses,
+                                    "%s_%s.xml" % (method, cls))
+            if os.path.exists(recorded):
+                # Recorded responses are sent whole, with their envelope
+                with open(recorded) as f:
+                    self.send_body(f.read())
+                return
+
+        self.send_body(response_header % method + body + response_footer)
+
+    def send_body(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", 'application/xml; charset="utf-8"')
+        self.send_header("CIMOperation", "MethodResponse")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves stand-in ECOM endpoints on localhost")
+    parser.add_argument('--endpoints', '-n', type=int, default=endpoint_count,
+                        help="Number of endpoints")
+    parser.add_argument('--port', '-p', type=int, default=base_port,
+                        help="Port of the first endpoint")
+    parser.add_argument('--serial', '-s', default=serial,
+                        help="Serial of the array the endpoints serve")
+    parser.add_argument('--responses', '-r',
+                        help="Directory of recorded responses")
+    parser.add_argument('--down', type=int, action="append", default=[],
+                        help="Don't start endpoint N (from 0), repeatable")
+    parser.add_argument('--ready_delay', type=float, default=0,
+                        help="Seconds before a registered array returns "
+                             "statistics")
+    parser.add_argument('--fail_ip', action="append", default=[],
+                        help="Fail the registration of this SPA, repeatable")
+
+    args = parser.parse_args()
+
+    registry = Registry(args.serial, args.ready_delay, args.fail_ip)
+
+    servers = []
+    for index in range(args.endpoints):
+        if index in args.down:
+            continue
+        server = StandInServer(("127.0.0.1", args.port + index),
+                               StandInHandler)
+        server.registry = registry
+        server.responses = args.responses
+        server.state = "recover"
+        server.served = 0
+        server.lock = threading.Lock()
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+
+    print " ".join(["http://127.0.0.1:%d" % i.server_address[1]
+                    for i in servers])
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            print "%d: %d requests" % (server.server_address[1],
+                                       server.served)
+
+
+if __name__ == "__main__":
+    main()